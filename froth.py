@@ -1,7 +1,20 @@
 import sys
+import time
+import argparse
+import os
+import mmap
 import random
 import enum
+import inspect
+import itertools
+import copy
+import pickle
+import zlib
+from operator import length_hint
+from array import array
 from io import StringIO
+from collections import ChainMap
+from types import MappingProxyType
 
 class Errors(enum.IntEnum):
     UNDEFINED = 0
@@ -13,6 +26,8 @@ class Errors(enum.IntEnum):
     MEMORY_ERROR = 6
     DEPTH_EXCEEDED = 7
     DIVIDE_BY_ZERO = 8
+    TIMEOUT = 9
+    YIELD = 10
 
 def isDigit(v):
     try:
@@ -34,6 +49,12 @@ class FakeEnumValue(object):
 
 tokenMap = {}
 flowWords = []
+# read-only view of the builtin words that every VM looks words up in
+BUILTINS = MappingProxyType(tokenMap)
+# every VM starts with the error codes defined as variables
+ERROR_VARIABLES = {err.name:int(err) for err in Errors}
+# source of VM.version, unique across VMs since they can share compiled ops
+VERSIONS = itertools.count()
 
 def flowWord(func):
     flowWords.append(func.__name__.strip("_"))
@@ -55,38 +76,311 @@ def argToken(num, name=None):
         return func
     return _
 
+class Block(list):
+    "Tokens of an if/macro body, which keeps its compiled ops around once a VM has built them"
+    ops = None
+    numeric = False
+
+
+class Memory(object):
+    "VM memory, a growable array of 64 bit cells. Addresses outside 0..len-1 raise IndexError"
+    def __init__(self):
+        self.cells = array("q")
+
+    def __len__(self):
+        return len(self.cells)
+
+    def __getitem__(self, pos):
+        if pos < 0:
+            raise IndexError(pos)
+        return self.cells[pos]
+
+    def __setitem__(self, pos, value):
+        if pos < 0:
+            raise IndexError(pos)
+        self.cells[pos] = value
+
+    def grow(self, size):
+        "Append size zeroed cells"
+        if size < 0:
+            raise IndexError(size)
+        self.cells.frombytes(bytes(size * self.cells.itemsize))
+
+    def shrink(self, size):
+        "Drop up to size cells off the end"
+        if size < 0:
+            raise IndexError(size)
+        del self.cells[max(len(self.cells) - size, 0):]
+
+    def span(self, pos, size):
+        "Slice for size cells starting at pos, IndexError unless it lies inside memory"
+        if pos < 0 or size < 0 or pos + size > len(self.cells):
+            raise IndexError(pos)
+        return slice(pos, pos + size)
+
+    def read(self, pos, size):
+        return self.cells[self.span(pos, size)]
+
+    def write(self, pos, values):
+        self.cells[self.span(pos, len(values))] = array("q", values)
+
+    def copy(self, src, dst, size):
+        "Copy size cells from src to dst, the ranges may overlap"
+        self.cells[self.span(dst, size)] = self.cells[self.span(src, size)]
+
+    def fill(self, pos, size, value):
+        self.cells[self.span(pos, size)] = array("q", [value]) * size
+
+    def dump(self):
+        "Raw cell contents, for load()"
+        return self.cells.tobytes()
+
+    def load(self, data):
+        "Replace every cell with the contents of a dump()"
+        self.shrink(len(self))
+        self.grow(len(data) // self.cells.itemsize)
+        self.cells[:] = array("q", data)
+
+    def clone(self):
+        "An independent in-process copy"
+        memory = Memory()
+        memory.cells.frombytes(self.dump())
+        return memory
+
+
+class BufferedOutput(object):
+    """Collects VM output and hands it to the underlying stream in chunks, once size characters
+    are pending, at the end of a line if lineBuffered, or when flushed. size=0 writes straight through"""
+    def __init__(self, stream, size=8192, lineBuffered=False):
+        self.stream = stream
+        self.size = size
+        self.lineBuffered = lineBuffered
+        self.buf = []
+        self.pending = 0
+
+    def write(self, data):
+        self.buf.append(data)
+        self.pending += len(data)
+        if self.pending >= self.size or (self.lineBuffered and "\n" in data):
+            self.flush()
+
+    def flush(self):
+        if not self.buf:
+            return
+        self.stream.write("".join(self.buf))
+        self.buf = []
+        self.pending = 0
+        self.stream.flush()
+
+
+class MappedMemory(Memory):
+    """Memory kept in an mmap of a file, which persists between runs. The file holds the raw
+    cells, so an existing file starts out with its old contents allocated"""
+    def __init__(self, path):
+        self.file = open(path, "a+b")
+        self.map = None
+        self.remap(os.fstat(self.file.fileno()).st_size // 8)
+
+    def remap(self, length):
+        if self.map is not None:
+            self.cells.release()
+            self.map.close()
+        os.ftruncate(self.file.fileno(), length * 8)
+        if length:
+            self.map = mmap.mmap(self.file.fileno(), length * 8)
+            self.cells = memoryview(self.map).cast("q")
+        else:
+            self.map = None
+            self.cells = memoryview(bytearray()).cast("q")
+
+    def __setitem__(self, pos, value):
+        try:
+            Memory.__setitem__(self, pos, value)
+        except ValueError:
+            raise OverflowError(value)
+
+    def grow(self, size):
+        if size < 0:
+            raise IndexError(size)
+        self.remap(len(self.cells) + size)
+
+    def shrink(self, size):
+        if size < 0:
+            raise IndexError(size)
+        self.remap(max(len(self.cells) - size, 0))
+
+    def flush(self):
+        if self.map is not None:
+            self.map.flush()
+
+    def close(self):
+        self.flush()
+        self.cells.release()
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+
+# words run between clock checks in VM.run(timeout=...)
+TIME_SLICE = 1000
+
+
+def scanFlow(tokens, pos):
+    "Find the body of a flow word starting at pos, the compile-time twin of VM.readFlow"
+    depth = 0
+    for end in range(pos, len(tokens)):
+        word = tokens[end]
+        if word in flowWords:
+            depth += 1
+        if word == ";":
+            if depth <= 0:
+                return Block(tokens[pos:end]), end + 1
+            depth -= 1
+    return None, pos
+
+
+class Program(object):
+    """Source lines plus everything VMs work out from them: tokens, compiled lines and the table
+    for skipping blank lines. VM(program) shares all of it, so a program only has to be parsed and
+    compiled once however many times it is started"""
+    def __init__(self, code, customWords=None):
+        self.code = code.split("\n") if isinstance(code, str) else code
+        # builtins are shared, custom words go in a small dict in front of them
+        self.tokens = ChainMap(dict(customWords or {}), BUILTINS)
+        # source line -> tokens, so lines revisited by jumps aren't re-lexed
+        self.tokenCache = {}
+        # source line -> ops, see VM.compile()
+        self.compiled = {}
+        # compiled ops per line, filled in as lines are reached
+        self.lines = [None] * len(self.code)
+        # skip[n] is the first line at or after n that isn't blank or a # comment
+        self.skip = [len(self.code)] * (len(self.code) + 1)
+        for pos in range(len(self.code) - 1, -1, -1):
+            line = self.code[pos].strip()
+            self.skip[pos] = pos if line and not line.startswith("#") else self.skip[pos + 1]
+
+    def precompile(self):
+        "Compile every line now rather than as VMs reach them"
+        vm = VM(self)
+        for pos, line in enumerate(self.code):
+            if self.skip[pos] == pos and self.lines[pos] is None:
+                self.lines[pos] = vm.compileLine(line)
+        return self
+
+
 class VM(object):
-    def __init__(self, code, output=sys.stdout, customWords={}):
+    def __init__(self, code, output=sys.stdout, customWords=None, maxDepth=10000, memoryFile=None,
+                 bufferSize=8192, lineBuffered=False):
+        "code is source text or a Program. customWords maps names to (func, argument count)"
         self.stack = []
-        self.tokens = tokenMap.copy()
-        self.tokens.update(customWords)
-
-        self.variables = {err.name:int(err) for err in Errors}
-        self.memory = []
+        if not isinstance(code, Program):
+            code = Program(code, customWords)
+            customWords = None
+        if customWords:
+            self.tokens = ChainMap(dict(customWords), BUILTINS)
+        else:
+            self.tokens = code.tokens
+
+        self.variables = ERROR_VARIABLES.copy()
+        self.memory = MappedMemory(memoryFile) if memoryFile else Memory()
         self.catchMap = {}
-        self.output = output
-        self.code = code.split("\n")
+        # flushed when the program ends or errors, or by the flush word
+        self.output = BufferedOutput(output, bufferSize, lineBuffered)
+        # set once a number has been bound with var/macro, after which literals have to be looked up
+        self.numericNames = False
+        # changes whenever a macro is bound or unbound, see opLoad()
+        self.version = next(VERSIONS)
+        self.load(code)
         self.pc = -1
-
-        self.curline = None
+        self.flowBody = None
+
+        # the rest of the current line as a stack of op iterators, the innermost if/macro body last
+        self.frames = []
+        # how many if/macro bodies may be nested before DEPTH_EXCEEDED
+        self.maxDepth = maxDepth
+        # words exec() may run before returning Errors.YIELD, negative for no limit. See run()
+        self.budget = -1
+        # set when exec() yielded partway through a line, so the next tick picks it back up
+        self.suspended = False
+        # awaitable returned by an async custom word, which the host has to finish before the VM goes on
+        self.awaiting = None
 
     def readFlow(self):
-        sequence = []
+        if self.flowBody is not None:
+            sequence, self.flowBody = self.flowBody, None
+            return sequence
+        sequence = Block()
         depth = 0
-        while (word := self.curline.pop(0)) != None:
-            if word in flowWords:
-                depth += 1
-            if word == ";":
-                if depth <= 0: break
-                depth -= 1
-            sequence.append(word)
-        return sequence
+        while True:
+            words = self.nextOp()[2]
+            for pos, word in enumerate(words):
+                if word in flowWords:
+                    depth += 1
+                if word == ";":
+                    if depth <= 0:
+                        if pos + 1 < len(words):
+                            self.pushFrame(self.compile(words[pos+1:]))
+                        return sequence
+                    depth -= 1
+                sequence.append(word)
+
+    def readWords(self, count):
+        "Take count raw words off the front of the current line"
+        words = []
+        while len(words) < count:
+            words.extend(self.nextOp()[2])
+        if len(words) > count:
+            self.pushFrame(self.compile(words[count:]))
+        return words[:count]
+
+    def nextOp(self):
+        "Take the next op off the current line, IndexError at the end of it"
+        frames = self.frames
+        while frames:
+            for op in frames[-1]:
+                return op
+            frames.pop()
+        raise IndexError("end of line")
+
+    def pushFrame(self, ops):
+        "Run ops before the rest of the current line"
+        self.frames.append(iter(ops))
+
+    def call(self, ops):
+        "Enter an if/macro body. Finished frames are dropped first, so tail calls don't nest"
+        frames = self.frames
+        while frames and not length_hint(frames[-1]):
+            frames.pop()
+        if len(frames) >= self.maxDepth:
+            return Errors.DEPTH_EXCEEDED
+        frames.append(iter(ops))
 
 
     def runUntilEnd(self):
-        while (thing := self.tick()) == Errors.SUCCESS:
-            pass
-        return thing
+        return self.run()
+
+    def run(self, steps=None, timeout=None):
+        """Run until the program ends or errors. With steps or timeout (seconds) it gives up after that
+        many words or that long and returns Errors.YIELD; calling run() or tick() again carries on"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            while True:
+                budget = -1 if deadline is None else TIME_SLICE
+                if steps is not None:
+                    budget = steps if budget < 0 else min(budget, steps)
+                    if budget <= 0:
+                        return Errors.YIELD
+                self.budget = budget
+                while (ret := self.tick()) is Errors.SUCCESS:
+                    pass
+                if ret is not Errors.YIELD or self.awaiting is not None:
+                    return ret
+                if steps is not None:
+                    steps -= budget
+                if deadline is not None and time.monotonic() >= deadline:
+                    return ret
+        finally:
+            self.budget = -1
 
     def tokenizer(self, string):
         ret = []
@@ -132,21 +426,275 @@ class VM(object):
 
 
 
-    def tick(self):
+    def tokenize(self, line):
+        "Tokenize a source line, reusing the result for lines seen before. None for blank/# lines"
+        try:
+            return self.tokenCache[line]
+        except KeyError:
+            pass
+        stripped = line.strip()
+        if stripped.startswith("#") or len(stripped) == 0:
+            tokens = None
+        else:
+            tokens = self.tokenizer(stripped)
+        self.tokenCache[line] = tokens
+        return tokens
+
+    # ------- Compiler --------
+    # A line compiles to a list of (func, args, source) ops which exec() calls as func(vm, *args).
+    # Builtins are resolved up front with their arguments bound, literals become pushes and
+    # everything else is looked up in self.variables when it runs. source holds the raw words
+    # the op was built from, for words that read ahead (readFlow/readWords) across op boundaries.
+
+    def compile(self, tokens):
+        ops = []
+        pos = 0
+        while pos < len(tokens):
+            word = tokens[pos]
+            start = pos
+            pos += 1
+            if word in self.tokens:
+                func, count = self.tokens[word]
+                args = tuple(tokens[pos:pos+count])
+                pos += len(args)
+                if len(args) < count:
+                    op = (VM.opLateArgs, (func, args, count - len(args)))
+                elif word in flowWords:
+                    body, end = scanFlow(tokens, pos)
+                    if body is None:
+                        op = (func, args)
+                    else:
+                        op = (VM.opFlow, (func, args, body))
+                        pos = end
+                else:
+                    op = (func, args)
+            elif isinstance(word, int) and not self.numericNames:
+                op = (VM.opPush, (word,))
+            else:
+                op = (VM.opLoad, (word, [None, None]))
+            ops.append(op + (tokens[start:pos],))
+        return self.optimize(ops) if self.peephole else ops
+
+    def compileLine(self, line):
+        "Ops for a source line, None for blank/# lines or an Errors value if it can't be tokenized"
+        try:
+            return self.compiled[line]
+        except KeyError:
+            pass
+        tokens = self.tokenize(line)
+        ops = self.compile(tokens) if isinstance(tokens, list) else tokens
+        self.compiled[line] = ops
+        return ops
+
+    def compileBlock(self, block):
+        if not isinstance(block, Block):
+            return self.compile(block)
+        if block.ops is None or block.numeric != self.numericNames:
+            block.ops = self.compile(block)
+            block.numeric = self.numericNames
+        return block.ops
+
+    def bindName(self, name, macro=False):
+        """Called before var/macro bind a name; binding a number stops literals being compiled as pushes.
+        Anything else changing self.variables has to call it too, or bump self.version"""
+        if macro or isinstance(self.variables.get(name), list):
+            self.version = next(VERSIONS)
+        if isinstance(name, int) and not self.numericNames:
+            self.version = next(VERSIONS)
+            self.numericNames = True
+            self.compiled = {}
+            self.lines = [None] * len(self.code)
+            words = [word for frame in reversed(self.frames) for op in frame for word in op[2]]
+            self.frames[:] = [iter(self.compile(words))]
+
+    def opPush(self, value):
+        self.stack.append(value)
+
+    def opLoad(self, word, cache):
+        "cache is [version, ops] of the macro word was last found to be, valid while self.version is the same"
+        if cache[0] == self.version:
+            return self.call(cache[1])
         try:
-            line = self.code[self.pc].rstrip().strip()
-        except:
-            return Errors.END_OF_PROGRAM
+            value = self.variables[word]
+        except KeyError:
+            if isinstance(word, int):
+                self.stack.append(word)
+                return
+            return Errors.UNKNOWN_WORD
+        if isinstance(value, list):
+            ops = self.compileBlock(value)
+            cache[:] = self.version, ops
+            return self.call(ops)
+        else:
+            self.stack.append(value)
+
+    def opFlow(self, func, args, body):
+        self.flowBody = body
+        try:
+            return func(self, *args)
+        finally:
+            self.flowBody = None
 
-        if line.startswith("#") or len(line) == 0:
-            self.pc += 1
-            return Errors.SUCCESS
+    def opLateArgs(self, func, args, missing):
+        try:
+            args += tuple(self.readWords(missing))
+        except IndexError:
+            return Errors.END_OF_LINE
+        return func(self, *args)
+
+    # ------- Peephole optimizer --------
+    # compile() passes its ops through optimize(), which fuses common sequences like `1 add`,
+    # `dup var x` or `swap drop` into one op and folds arithmetic on literals. A fused op leaves the
+    # stack and returns exactly what the words it replaces would have, including on underflow, but
+    # only counts as one word against the run() budget.
+    peephole = True
+
+    def optimize(self, ops):
+        out = []
+        for op in ops:
+            while out:
+                fused = self.fuse(out[-1], op)
+                if fused is None:
+                    break
+                op = fused + (out.pop()[2] + op[2],)
+            out.append(op)
+        return out
+
+    def fuse(self, first, second):
+        "(func, args) for one op doing the work of first then second, None if there isn't one"
+        (func, args, _), (nextFunc, nextArgs, _) = first, second
+        if func is VM.opPush:
+            if nextFunc in LITERAL_OPS and not nextArgs:
+                return (LITERAL_OPS[nextFunc], (args[0], nextFunc))
+            if nextFunc in LITERAL_FUNCS and nextArgs[1] in FOLDS:
+                try:
+                    return (VM.opPush, (FOLDS[nextArgs[1]](args[0], nextArgs[0]),))
+                except ZeroDivisionError:
+                    # left for the program to run into
+                    return None
+            if nextFunc is VM._not:
+                return (VM.opPush, (~args[0],))
+        elif func is VM.opPushCall and args == (0, VM.eq) and nextFunc is VM._not:
+            return (VM.opNonZero, ())
+        elif func is VM.dup and nextFunc is VM.var and len(nextArgs) == 1:
+            return (VM.opDupVar, nextArgs)
+        elif (func, nextFunc) in PAIRS:
+            return (PAIRS[func, nextFunc], ())
+        return None
+
+    def opAddConst(self, value, func):
+        "n add"
+        self.stack[-1] += value
+
+    def opSubConst(self, value, func):
+        "n sub"
+        try:
+            self.stack[-1] -= value
+        except IndexError:
+            # sub leaves the n it couldn't use behind
+            self.stack.append(value)
+            raise
+
+    def opPushCall(self, value, func):
+        "n followed by a word taking two numbers"
+        self.stack.append(value)
+        return func(self)
+
+    def opNonZero(self):
+        "0 eq not"
+        self.stack[-1] = -1 if self.stack[-1] else 0
+
+    def opDupVar(self, name):
+        "dup var name"
+        value = self.stack[-1]
+        self.bindName(name)
+        self.variables[name] = value
+
+    def opNip(self):
+        "swap drop"
+        del self.stack[-2]
+
+    def opDropDrop(self):
+        "drop drop"
+        self.stack.pop()
+        self.stack.pop()
 
-        self.curline = self.tokenizer(line)
-        if not isinstance(self.curline, list):
-            return self.curline
+    def opOverOver(self):
+        "over over"
+        self.stack.append(self.stack[-2])
+        self.stack.append(self.stack[-2])
+
+    @property
+    def code(self):
+        return self.program.code
+
+    @code.setter
+    def code(self, lines):
+        self.load(Program(lines))
+
+    def load(self, program):
+        "Switch to program's source. Its compiled lines are only reused if they were built for our words"
+        self.program = program
+        self.skip = program.skip
+        self.tokenCache = program.tokenCache
+        if self.tokens is program.tokens and not self.numericNames:
+            self.compiled = program.compiled
+            self.lines = program.lines
+        else:
+            self.compiled = {}
+            self.lines = [None] * len(program.code)
+
+    def tick(self, steps=None):
+        "Run the next line, or with steps at most that many words of it before yielding"
+        if steps is None:
+            ret = self.runLine()
+        else:
+            self.budget = steps
+            try:
+                ret = self.runLine()
+            finally:
+                self.budget = -1
+        if ret is not Errors.SUCCESS:
+            self.output.flush()
+        return ret
 
-        ret = self.exec()
+    def runLine(self):
+        if self.suspended:
+            if self.awaiting is not None:
+                return Errors.YIELD
+            self.suspended = False
+            return self.endLine(self.exec())
+        if self.pc >= 0:
+            try:
+                pc = self.pc = self.skip[self.pc]
+                ops = self.lines[pc]
+            except (IndexError, TypeError):
+                return Errors.END_OF_PROGRAM
+            if ops is None:
+                ops = self.lines[pc] = self.compileLine(self.code[pc])
+        else:
+            try:
+                ops = self.compileLine(self.code[self.pc])
+            except IndexError:
+                return Errors.END_OF_PROGRAM
+            if ops is None:
+                self.pc += 1
+                return Errors.SUCCESS
+        if not isinstance(ops, list):
+            return ops
+
+        self.frames = [iter(ops)]
+        return self.endLine(self.exec())
+
+    def endLine(self, ret):
+        if ret is Errors.YIELD:
+            self.suspended = True
+            return ret
+        if not isinstance(ret, (Errors, FakeEnumValue)) and inspect.isawaitable(ret):
+            # an async custom word handed back an awaitable, see resume()
+            self.awaiting = ret
+            self.suspended = True
+            return Errors.YIELD
         if ret.value in self.catchMap:
             if self.catchMap[ret.value] >= 0:
                 self.pc = self.catchMap[ret.value]
@@ -155,41 +703,128 @@ class VM(object):
         return ret
 
 
-    def exec(self):
-        try:
-            while (word := self.curline.pop(0)) != None:
-
-                if word in self.tokens:
-                    args = []
-                    try:
-                        for _ in range(self.tokens[word][1]):
-                            args.append(self.curline.pop(0))
-                    except IndexError:
-                        return Errors.END_OF_LINE
-
-                    try:
-                        ret = self.tokens[word][0](self, *args)
-                    except IndexError:
-                        return Errors.STACK_UNDERFLOW
-                    if ret:
-                        return ret
-                elif word in self.variables:
-                    if isinstance(self.variables[word], list):
-                        self.curline = self.variables[word].copy() + self.curline
-                    else:
-                        self.stack.append(self.variables[word])
-                elif isinstance(word, int):
-                    self.stack.append(int(word))
-                else:
-                    return Errors.UNKNOWN_WORD
+    # ------- Snapshots --------
+    SNAPSHOT_VERSION = 1
+
+    def snapshot(self):
+        """Serialize the complete state of the VM, including a half finished line, to bytes for restore().
+        Custom words aren't included and have to be passed to restore() again"""
+        if self.awaiting is not None:
+            raise ValueError("can't snapshot a VM waiting on an async word")
+        self.output.flush()
+        frames = []
+        if self.suspended:
+            frames = [[word for op in copy.copy(frame) for word in op[2]] for frame in self.frames]
+        state = {
+            "version": self.SNAPSHOT_VERSION,
+            "code": self.code,
+            "pc": self.pc,
+            "stack": self.stack,
+            # (name, value, is a macro)
+            "variables": [(name, list(value) if isinstance(value, list) else value, isinstance(value, list))
+                          for name, value in self.variables.items()],
+            "memory": self.memory.dump(),
+            "catchMap": self.catchMap,
+            "frames": frames,
+            "suspended": self.suspended,
+            "maxDepth": self.maxDepth,
+        }
+        return zlib.compress(pickle.dumps(state, pickle.HIGHEST_PROTOCOL))
+
+    @classmethod
+    def restore(cls, data, **kw):
+        """Rebuild a VM from snapshot() bytes. Keyword arguments are passed to VM(), e.g. output and
+        customWords. Snapshots are pickles, so only restore ones you made"""
+        state = pickle.loads(zlib.decompress(data))
+        if state["version"] != cls.SNAPSHOT_VERSION:
+            raise ValueError(f"unsupported snapshot version {state['version']}")
+        kw.setdefault("maxDepth", state["maxDepth"])
+        vm = cls(Program(state["code"], kw.pop("customWords", None)), **kw)
+        vm.pc = state["pc"]
+        vm.stack = state["stack"]
+        vm.variables = {}
+        for name, value, isMacro in state["variables"]:
+            vm.bindName(name, isMacro)
+            vm.variables[name] = Block(value) if isMacro else value
+        vm.memory.load(state["memory"])
+        vm.catchMap = state["catchMap"]
+        vm.frames = [iter(vm.compile(words)) for words in state["frames"]]
+        vm.suspended = state["suspended"]
+        return vm
+
+    def clone(self, output=None):
+        """Fork the VM in-process: the copy carries on from exactly this point independently, sharing only
+        the program. Output goes to the same stream unless another one is given"""
+        if self.awaiting is not None:
+            raise ValueError("can't clone a VM waiting on an async word")
+        self.output.flush()
+        vm = copy.copy(self)
+        vm.stack = self.stack.copy()
+        vm.variables = self.variables.copy()
+        vm.catchMap = self.catchMap.copy()
+        vm.memory = self.memory.clone()
+        vm.frames = [copy.copy(frame) for frame in self.frames]
+        vm.output = BufferedOutput(output if output is not None else self.output.stream,
+                                   self.output.size, self.output.lineBuffered)
+        # tracers and profilers stay with the VM they were attached to
+        for name in [name for name in vars(vm) if callable(getattr(VM, name, None))]:
+            del vm.__dict__[name]
+        vm.__dict__.pop("debugHook", None)
+        return vm
+
+    def resume(self, ret):
+        """Hand back the result of awaiting vm.awaiting. An error ends the line the same way it would have
+        from a normal word, otherwise the line carries on at the next tick"""
+        self.awaiting = None
+        if ret:
+            self.suspended = False
+            ret = self.endLine(ret)
+            if ret is not Errors.SUCCESS:
+                self.output.flush()
+            return ret
+        return Errors.SUCCESS
+
+    def exec(self, run=None):
+        """Run the current line's frames until the line ends, an op returns an error or the budget is
+        used up. Profilers and tracers pass run(vm, func, args, source), which is called in place of
+        func(vm, *args) for every op and returns what it does. Without it the ops run as they are"""
+        frames = self.frames
+        # words left before yielding, negative for no limit
+        budget = self.budget
+        if not budget:
+            return Errors.YIELD
+        while frames:
+            frame = frames[-1]
+            for func, args, _ in (frame if run is None else hookOps(frame, run)):
+                try:
+                    ret = func(self, *args)
+                except IndexError:
+                    self.budget = budget - 1
+                    return Errors.STACK_UNDERFLOW
+                budget -= 1
+                if ret:
+                    self.budget = budget
+                    return ret
+                if frames[-1] is not frame or not budget:
+                    # a body was pushed or the frame was read to its end, pick up the new innermost one
+                    break
+            else:
+                frames.pop()
+            if not budget:
+                self.budget = 0
+                return Errors.YIELD
+        self.budget = budget
+        self.pc += 1
+        return Errors.SUCCESS
 
-        except IndexError:
-            self.pc += 1
-            return Errors.SUCCESS
 
+    # set by frothtrace.attach() for tracers that take over the debug word
+    debugHook = None
 
     @token
     def debug(self):
+        if self.debugHook is not None:
+            return self.debugHook(self)
         self.output.write(f"[DEBUG] pc = {self.pc} | stack = {self.stack} | variables = {self.variables}\n")
         self.output.flush()
 
@@ -298,18 +933,20 @@ class VM(object):
     def p(self):
         "( a -- )"
         self.output.write(str(self.stack.pop()))
-        self.output.flush()
 
     @token
     def emit(self):
         "( a -- )"
         self.output.write(chr(self.stack.pop()))
-        self.output.flush()
 
     @token
     def cr(self):
         "( -- )"
         self.output.write("\n")
+
+    @token
+    def flush(self):
+        "( -- )"
         self.output.flush()
 
     # ------- Boolean ops --------
@@ -355,7 +992,7 @@ class VM(object):
         except IndexError:
             return Errors.END_OF_LINE
         if self.stack.pop():
-            self.curline = sequence + self.curline
+            return self.call(self.compileBlock(sequence))
 
     @token
     def catch(self):
@@ -380,17 +1017,26 @@ class VM(object):
     @argToken(1)
     def var(self, name):
         "( var -- )"
+        self.bindName(name)
         self.variables[name] = self.stack.pop()
 
     @token
     def alloc(self):
         "( size -- )"
-        self.memory += [0 for _ in range(self.stack.pop())]
+        size = self.stack.pop()
+        try:
+            self.memory.grow(size)
+        except IndexError:
+            return Errors.MEMORY_ERROR
 
     @token
     def dealloc(self):
         "( size -- )"
-        self.memory = self.memory[:self.stack.pop()*-1:]
+        size = self.stack.pop()
+        try:
+            self.memory.shrink(size)
+        except IndexError:
+            return Errors.MEMORY_ERROR
 
     @token
     def memread(self):
@@ -408,9 +1054,57 @@ class VM(object):
         address = self.stack.pop()
         try:
             self.memory[address] = data
+        except (IndexError, OverflowError):
+            return Errors.MEMORY_ERROR
+
+    @token
+    def memcopy(self):
+        "( src dst size -- )"
+        size = self.stack.pop()
+        dst = self.stack.pop()
+        src = self.stack.pop()
+        try:
+            self.memory.copy(src, dst, size)
+        except IndexError:
+            return Errors.MEMORY_ERROR
+
+    @token
+    def memfill(self):
+        "( address size value -- )"
+        value = self.stack.pop()
+        size = self.stack.pop()
+        address = self.stack.pop()
+        try:
+            self.memory.fill(address, size, value)
+        except (IndexError, OverflowError):
+            return Errors.MEMORY_ERROR
+
+    @token
+    def memload(self):
+        "( address size -- ...values )"
+        size = self.stack.pop()
+        address = self.stack.pop()
+        try:
+            self.stack.extend(self.memory.read(address, size))
         except IndexError:
             return Errors.MEMORY_ERROR
 
+    @token
+    def memstore(self):
+        "( ...values address size -- )"
+        size = self.stack.pop()
+        address = self.stack.pop()
+        if size < 0:
+            return Errors.MEMORY_ERROR
+        if size > len(self.stack):
+            return Errors.STACK_UNDERFLOW
+        values = self.stack[len(self.stack) - size:]
+        try:
+            self.memory.write(address, values)
+        except (IndexError, OverflowError):
+            return Errors.MEMORY_ERROR
+        del self.stack[len(self.stack) - size:]
+
     @token
     def here(self):
         "( -- [memory end position] )"
@@ -424,4 +1118,100 @@ class VM(object):
             sequence = self.readFlow()
         except IndexError:
             return Errors.END_OF_LINE
+        self.bindName(name, macro=True)
         self.variables[name] = sequence
+
+
+# words that take two numbers off the stack, `n word` is fused into one op
+LITERAL_OPS = {func: VM.opPushCall for func in (VM.mul, VM.div, VM.mod, VM.xor, VM.lshift, VM.rshift,
+                                                VM._and, VM._or, VM.eq, VM.lt, VM.gt)}
+LITERAL_OPS[VM.add] = VM.opAddConst
+LITERAL_OPS[VM.sub] = VM.opSubConst
+LITERAL_FUNCS = set(LITERAL_OPS.values())
+# `a b word` with both literals is worked out at compile time, a being the deeper one
+FOLDS = {
+    VM.add: lambda a, b: a + b,
+    VM.sub: lambda a, b: a - b,
+    VM.mul: lambda a, b: a * b,
+    VM.div: lambda a, b: a // b,
+    VM.mod: lambda a, b: b % a,
+    VM.xor: lambda a, b: a ^ b,
+    VM._and: lambda a, b: a & b,
+    VM._or: lambda a, b: a | b,
+    VM.eq: lambda a, b: -1 if a == b else 0,
+    VM.lt: lambda a, b: -1 if a < b else 0,
+    VM.gt: lambda a, b: -1 if a > b else 0,
+}
+# pairs of stack words that have a single op doing both
+PAIRS = {
+    (VM.swap, VM.drop): VM.opNip,
+    (VM.drop, VM.drop): VM.opDropDrop,
+    (VM.over, VM.over): VM.opOverOver,
+}
+
+
+def hookOps(frame, run):
+    "frame's ops, each one turned into a call to run(vm, func, args, source), see VM.exec"
+    for func, args, source in frame:
+        yield run, (func, args, source), source
+
+
+def readChar(vm):
+    "( -- char/-1 )"
+    char = sys.stdin.read(1)
+    vm.stack.append(ord(char) if char else -1)
+
+
+def exitStatus(ret):
+    "Process exit status for the result of a run, 0 when it reached the end of the program"
+    if ret == Errors.END_OF_PROGRAM:
+        return 0
+    return (ret.value & 0xFF) or 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="froth", description="Run froth programs without the IDE")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="run .froth files one after another")
+    run.add_argument("files", nargs="+", help="program files, - to read a program from stdin")
+    run.add_argument("--line-buffered", action="store_true", help="flush output at every newline")
+    run.add_argument("--max-depth", type=int, default=10000, help="maximum if/macro nesting")
+    run.add_argument("--max-steps", type=int, help="stop a program with TIMEOUT after this many words")
+    run.add_argument("--timeout", type=float, help="stop a program with TIMEOUT after this many seconds")
+    run.add_argument("--profile", action="store_true", help="print where the time went to stderr afterwards")
+    run.add_argument("--collapsed", metavar="PATH", help="write profiled stacks for flamegraph.pl to PATH")
+    args = parser.parse_args(argv)
+
+    profiler = None
+    if args.profile or args.collapsed:
+        import frothprof
+        profiler = frothprof.Profiler()
+    status = 0
+    for path in args.files:
+        if path == "-":
+            code = sys.stdin.read()
+        else:
+            with open(path) as f:
+                code = f.read()
+        vm = VM(code, output=sys.stdout, customWords={"read": (readChar, 0)},
+                maxDepth=args.max_depth, lineBuffered=args.line_buffered)
+        if profiler:
+            profiler.attach(vm)
+        ret = vm.run(steps=args.max_steps, timeout=args.timeout)
+        if ret == Errors.YIELD:
+            ret = Errors.TIMEOUT
+        if ret != Errors.END_OF_PROGRAM:
+            sys.stderr.write(f"{path}: {ret.name} at line {vm.pc}\n")
+            status = exitStatus(ret)
+    if args.profile:
+        sys.stderr.write(profiler.report())
+    if args.collapsed:
+        with open(args.collapsed, "w") as f:
+            f.write(profiler.collapsed())
+    return status
+
+
+if __name__ == '__main__':
+    # go through the importable module, so frothprof sees the same VM and Errors as we do
+    import froth
+    sys.exit(froth.main())
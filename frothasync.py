@@ -0,0 +1,56 @@
+"""Host many froth VMs in one asyncio event loop.
+
+    scheduler = Scheduler()
+    scheduler.spawn(froth.VM(code, customWords={"recv": (recv, 0)}), hz=30)
+    await scheduler.join()
+
+Each VM runs as a task that executes at most `slice` words before letting the other tasks have a
+turn, so one busy or looping program can't starve the rest. With hz a VM runs that many lines per
+second, like the IDE's Hz slider, otherwise it goes as fast as the loop allows.
+
+Custom words may be async: a word that returns an awaitable (e.g. an `async def` taking the vm)
+suspends its VM until it is done. Its result is treated like a normal word's return value, so it
+can return an Errors value to stop the line.
+"""
+import asyncio
+
+import froth
+
+
+class Scheduler(object):
+    def __init__(self, slice=1000):
+        self.slice = slice
+        self.tasks = set()
+
+    def spawn(self, vm, hz=None):
+        "Start running vm, the task's result is the code it ended with. Needs a running event loop"
+        task = asyncio.ensure_future(self.runVM(vm, hz))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def join(self):
+        "Wait for every VM started so far, returning their end codes"
+        return await asyncio.gather(*self.tasks)
+
+    async def runVM(self, vm, hz=None):
+        while True:
+            if vm.awaiting is not None:
+                try:
+                    ret = await vm.awaiting
+                except IndexError:
+                    ret = froth.Errors.STACK_UNDERFLOW
+                ret = vm.resume(ret)
+                if ret is froth.Errors.SUCCESS:
+                    continue
+            elif hz:
+                ret = vm.tick(steps=self.slice)
+            else:
+                ret = vm.run(steps=self.slice)
+
+            if ret is froth.Errors.YIELD:
+                await asyncio.sleep(0)
+            elif ret is froth.Errors.SUCCESS:
+                await asyncio.sleep(1 / hz if hz else 0)
+            else:
+                return ret
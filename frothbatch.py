@@ -0,0 +1,44 @@
+"""Run many independent froth programs across a process pool.
+
+    results = runBatch(sources, customWords=makeWords, maxSteps=1000000, timeout=5)
+
+customWords is a factory returning the customWords dict for a VM, so it has to be picklable
+(a module level function). Each result holds the final stack, everything the program printed and
+its end code. A program that makes Python itself raise gets error None and an errorName of
+"EXCEPTION: ..." instead, so it doesn't take the rest of the batch down with it.
+"""
+import collections
+import concurrent.futures
+import functools
+import io
+import os
+
+import froth
+
+BatchResult = collections.namedtuple("BatchResult", "stack output error errorName pc")
+
+
+def runProgram(code, customWords=None, maxSteps=None, timeout=None):
+    "Run one program in this process. Errors.TIMEOUT when it runs past maxSteps words or timeout seconds"
+    output = io.StringIO()
+    vm = None
+    try:
+        vm = froth.VM(code, output=output, customWords=customWords() if customWords else {})
+        ret = vm.run(steps=maxSteps, timeout=timeout)
+    except Exception as e:
+        if vm:
+            vm.output.flush()
+        return BatchResult(vm.stack if vm else [], output.getvalue(), None,
+                           f"EXCEPTION: {type(e).__name__}: {e}", vm.pc if vm else -1)
+    if ret == froth.Errors.YIELD:
+        ret = froth.Errors.TIMEOUT
+    return BatchResult(vm.stack, output.getvalue(), int(ret.value), ret.name, vm.pc)
+
+
+def runBatch(sources, customWords=None, maxSteps=None, timeout=None, workers=None):
+    "Run every program in sources on a pool of worker processes, results come back in order"
+    sources = list(sources)
+    workers = workers or os.cpu_count() or 1
+    run = functools.partial(runProgram, customWords=customWords, maxSteps=maxSteps, timeout=timeout)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(run, sources, chunksize=max(1, len(sources) // (workers * 4))))
@@ -0,0 +1,205 @@
+"""Benchmarks for the froth interpreter.
+
+    python frothbench.py                       time every workload
+    python frothbench.py count memory          just some of them
+    python frothbench.py --rev HEAD~3          compare against froth.py as of a git revision
+    python frothbench.py --baseline old.py     compare against another froth.py
+
+For each workload it reports the best time, words and ticks run per second, the peak memory
+traced while running it and how many allocated blocks the finished VM holds on to. Words are source words,
+counted once with the peephole pass off, so the rate stays comparable between revisions.
+"""
+import argparse
+import importlib.util
+import io
+import os
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import froth
+
+COUNT = """
+100000 var count
+line 1 add var loop
+count 1 sub dup var count 0 eq not if loop jump ;
+"""
+
+MACRO = """
+macro dec 1 sub ;
+macro step dup dec swap drop ;
+20000 line 1 add var loop
+step step step dup 0 gt if loop jump ;
+"""
+
+# frothdemo.DEMO with a longer loop
+DEMO = """
+( macro that subtracts one from the top of the stack )
+macro dec ( a -- a-1 ) 1 sub ;
+
+5000 var loopbegin
+
+line 1 add var line_position
+loopbegin
+50 loopbegin mul ( 5 * current loop iter > x1 )
+10 ( y1 )
+loopbegin loopbegin mul  ( iter * iter > x2 )
+loopbegin 20 mul 2 div  ( iter / 2 > y2 )
+drawline ( draw, adds the id onto the stack )
+loopbegin dec dup var loopbegin 0 eq  not if line_position jump ;
+"""
+
+# a macro calling itself in tail position, so it recurses without nesting frames
+RECURSION = """
+macro down dup if 1 sub down ; ;
+200 var rounds
+line 1 add var loop
+1000 down drop rounds 1 sub dup var rounds if loop jump ;
+"""
+
+# write then read back every cell
+MEMORY = """
+1000 alloc
+100 var rounds
+line 1 add var loop
+0 var i
+i i memwrite i 1 add dup var i 1000 lt if line jump ;
+0 var i
+i memread drop i 1 add dup var i 1000 lt if line jump ;
+rounds 1 sub dup var rounds if loop jump ;
+"""
+
+# every line is different, so each one has to be tokenized
+STRINGS = "\nmacro dropn dup if swap drop 1 sub dropn ; ;\n" + "\n".join(
+    f'"line {n} of the string workload" dropn drop "{n}" dropn drop' for n in range(2000)) + "\n"
+
+# raise caught by jumping back to the raising line
+CATCH = """
+20000 var i
+35 line 1 add catch
+i 1 sub dup var i if 35 raise ;
+"""
+
+ALLOC = """
+2000 var rounds
+line 1 add var loop
+100000 alloc 100000 dealloc rounds 1 sub dup var rounds if loop jump ;
+"""
+
+WORKLOADS = {
+    "count": COUNT,
+    "macro": MACRO,
+    "demo": DEMO,
+    "recursion": RECURSION,
+    "memory": MEMORY,
+    "strings": STRINGS,
+    "catch": CATCH,
+    "alloc": ALLOC,
+}
+
+
+def drawline(vm):
+    "( x1 y1 x2 y2 -- id )"
+    del vm.stack[-4:]
+    vm.stack.append(0)
+
+
+class WordCounter(froth.VM):
+    peephole = False
+
+
+def load(path):
+    spec = importlib.util.spec_from_file_location("froth_baseline", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def loadRevision(rev):
+    "froth.py as of a git revision"
+    source = subprocess.run(["git", "show", f"{rev}:froth.py"], check=True, capture_output=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    with tempfile.NamedTemporaryFile("wb", suffix=".py", delete=False) as f:
+        f.write(source)
+    try:
+        return load(f.name)
+    finally:
+        os.unlink(f.name)
+
+
+def makeVM(cls, code):
+    return cls(code, output=io.StringIO(), customWords={"drawline": (drawline, 0)})
+
+
+def finish(module, vm):
+    "Run vm to the end, returning how many ticks that took"
+    ticks = 0
+    while (ret := vm.tick()) == module.Errors.SUCCESS:
+        ticks += 1
+    assert ret == module.Errors.END_OF_PROGRAM, ret
+    return ticks
+
+
+def countWords(code):
+    vm = makeVM(WordCounter, code)
+    vm.budget = 1 << 62
+    finish(froth, vm)
+    return (1 << 62) - vm.budget
+
+
+def bench(module, code, repeat):
+    "(best time, ticks, peak traced bytes, blocks allocated at the end)"
+    best = None
+    for _ in range(repeat):
+        vm = makeVM(module.VM, code)
+        begin = time.perf_counter()
+        ticks = finish(module, vm)
+        elapsed = time.perf_counter() - begin
+        if best is None or elapsed < best:
+            best = elapsed
+
+    tracemalloc.start()
+    try:
+        vm = makeVM(module.VM, code)
+        finish(module, vm)
+        peak = tracemalloc.get_traced_memory()[1]
+        # taken while vm is still alive, so everything the run built up is counted
+        blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+    finally:
+        tracemalloc.stop()
+    return best, ticks, peak, blocks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time froth workloads, optionally against another froth.py")
+    compare = parser.add_mutually_exclusive_group()
+    compare.add_argument("--baseline", help="path to a froth.py to compare against")
+    compare.add_argument("--rev", help="git revision whose froth.py to compare against")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("workloads", nargs="*", default=list(WORKLOADS))
+    args = parser.parse_args()
+    for name in args.workloads:
+        if name not in WORKLOADS:
+            parser.error(f"unknown workload {name}, pick from {', '.join(WORKLOADS)}")
+
+    baseline = None
+    if args.baseline:
+        baseline = load(args.baseline)
+    elif args.rev:
+        baseline = loadRevision(args.rev)
+    for name in args.workloads:
+        code = WORKLOADS[name]
+        words = countWords(code)
+        elapsed, ticks, peak, blocks = bench(froth, code, args.repeat)
+        report = (f"{name:10} {elapsed*1000:9.1f} ms {words/elapsed:12.0f} words/s {ticks/elapsed:10.0f} ticks/s"
+                  f" {peak/1024:9.0f} KiB peak {blocks:8} blocks")
+        if baseline:
+            base, _, basePeak, baseBlocks = bench(baseline, code, args.repeat)
+            report += (f" | baseline {base*1000:9.1f} ms {basePeak/1024:9.0f} KiB {baseBlocks:8} blocks"
+                       f"  x{base/elapsed:.2f}")
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
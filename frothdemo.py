@@ -0,0 +1,23 @@
+"The program the IDE starts with"
+
+DEMO = """
+( macro that subtracts one from the top of the stack )
+macro dec ( a -- a-1 ) 1 sub ;
+
+( We will count down from this value )
+20 var loopbegin
+
+( load the position of one line below this into the variable "line_position" )
+line 1 add var line_position
+( load the current value into stack for demostration )
+loopbegin
+( draw a neat line )
+50 loopbegin mul ( 5 * current loop iter > x1 )
+10 ( y1 ) 
+loopbegin loopbegin mul  ( iter * iter > x2 )
+loopbegin 20 mul 2 div  ( iter / 2 > y2 )
+drawline ( draw, adds the id onto the stack )
+( loads our current position onto the stack, subtracts one from it, overwrite the old variable, check if it is equal to zero, )
+( and if not, jump to the beginning of the loop )
+loopbegin dec dup var loopbegin 0 eq  not if line_position jump ;
+"""
\ No newline at end of file
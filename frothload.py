@@ -0,0 +1,152 @@
+"""Load generator for a froth relay server.
+
+    python frothload.py                              against a server started in this process
+    python frothload.py --connect host:port --key k  against a running one
+    python frothload.py --clients 2000 --binary
+
+Connects --clients clients, then each sends --messages messages of --size ints to randomly picked
+clients, with at most --window of them waiting on a return code at a time. Reports messages
+relayed per second and the latency from sending a message to its target reading it.
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+import frothnet
+import frothserver
+
+
+class LoadClient(object):
+    def __init__(self, binary):
+        self.binary = binary
+        self.buf = bytearray()
+        self.latencies = []
+        # return codes still to come
+        self.pending = 0
+        self.replied = asyncio.Event()
+
+    async def connect(self, host, port, key):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.write(b"%s\n" % key.encode("utf8"))
+        if self.binary:
+            self.writer.write(b"binary\n")
+        self.id = int(await self.reader.readline())
+        if self.binary and (await self.reader.readline()).strip() != b"binary":
+            raise ConnectionError("server doesn't speak the binary protocol")
+
+    async def send(self, targets, count, size, window):
+        padding = [0] * (size - 1)
+        seq = 0
+        for _ in range(count):
+            while self.pending >= window:
+                self.replied.clear()
+                await self.replied.wait()
+            seq += 1
+            data = [time.perf_counter_ns()] + padding
+            target = random.choice(targets)
+            if self.binary:
+                self.writer.write(frothnet.encodeFrame(frothnet.MESSAGE, [seq, target] + data))
+            else:
+                self.writer.write(b"%d %s\n" % (target, " ".join(map(str, data)).encode()))
+            self.pending += 1
+            await self.writer.drain()
+
+    async def read(self):
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                return
+            self.buf += data
+            self.parse()
+
+    def parse(self):
+        buf = self.buf
+        pos = 0
+        now = time.perf_counter_ns()
+        while True:
+            if self.binary:
+                frame = frothnet.readFrame(buf, pos)
+                if frame is None:
+                    break
+                kind, values, pos = frame
+                isCode = kind == frothnet.CODE
+            else:
+                line = frothnet.readLine(buf, pos)
+                if line is None:
+                    break
+                values, pos = line
+                isCode = len(values) == 1
+            if isCode:
+                self.pending -= 1
+                self.replied.set()
+            else:
+                self.latencies.append(now - int(values[1]))
+        del buf[:pos]
+
+
+async def run(host, port, key, clients, messages, size, window, binary):
+    "Returns (elapsed seconds, latencies in ns)"
+    loads = [LoadClient(binary) for _ in range(clients)]
+    for load in loads:
+        await load.connect(host, port, key)
+    targets = [load.id for load in loads]
+    total = clients * messages
+    received = lambda: sum(len(load.latencies) for load in loads) >= total
+
+    start = time.perf_counter()
+    readers = [asyncio.ensure_future(load.read()) for load in loads]
+    await asyncio.gather(*(load.send(targets, messages, size, window) for load in loads))
+    while not received():
+        await asyncio.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    for task in readers:
+        task.cancel()
+    await asyncio.gather(*readers, return_exceptions=True)
+    for load in loads:
+        load.writer.close()
+        await load.writer.wait_closed()
+    return elapsed, [latency for load in loads for latency in load.latencies]
+
+
+async def runLocal(args):
+    relay = frothserver.Server(args.key)
+    server = await relay.start()
+    async with server:
+        port = server.sockets[0].getsockname()[1]
+        result = await run("127.0.0.1", port, args.key, args.clients, args.messages, args.size, args.window, args.binary)
+        # let the server see every client go before it is shut down
+        while relay.clients:
+            await asyncio.sleep(0.01)
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark a froth relay server")
+    parser.add_argument("--connect", help="host:port of a running server, otherwise one is started here")
+    parser.add_argument("--key", default="froth")
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=100, help="messages sent by each client")
+    parser.add_argument("--size", type=int, default=8, help="ints per message")
+    parser.add_argument("--window", type=int, default=16, help="messages each client has waiting on a return code")
+    parser.add_argument("--binary", action="store_true", help="use the binary protocol")
+    args = parser.parse_args()
+    if args.size < 1:
+        parser.error("--size must be at least 1")
+
+    if args.connect:
+        host, port = args.connect.split(":")
+        elapsed, latencies = asyncio.run(run(host, int(port), args.key, args.clients, args.messages, args.size,
+                                             args.window, args.binary))
+    else:
+        elapsed, latencies = asyncio.run(runLocal(args))
+    latencies.sort()
+    percentile = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))] / 1e6
+    print(f"{len(latencies)} messages in {elapsed:.2f} s, {len(latencies)/elapsed:.0f} messages/s")
+    print(f"latency ms: mean {statistics.mean(latencies)/1e6:.2f} p50 {percentile(0.5):.2f}"
+          f" p99 {percentile(0.99):.2f} max {latencies[-1]/1e6:.2f}")
+
+
+if __name__ == '__main__':
+    main()
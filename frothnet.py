@@ -0,0 +1,494 @@
+"""Networking words for froth VMs, talking to a relay server over TCP.
+
+Lines go out as `target data...` and come back as `sender data...`, plus a return code line for
+every message sent. Nothing here blocks: words queue what they send and Network.tick(), which the
+host calls regularly, writes queued lines out and reads whatever has arrived. Return codes come
+back in the order messages were sent, which is how they are matched up with the sequence id each
+send was given.
+
+Network(..., binary=True) asks for the binary protocol with a `binary` line after the key. A server
+that speaks it answers its id line with a `binary` line of its own, after which both sides send
+frames: a FRAME header (payload length in bytes, kind) and the payload as little endian 64 bit ints.
+Messages go out as MESSAGE frames of (seq, target, data...) and come in as (sender, data...), return
+codes come back as CODE frames of (seq, code). Any other answer is an older server, which treats the
+`binary` line as a message to nobody, so the connection carries on as text.
+
+send suspends its VM until the return code is back, hosts pick it back up with resumeIfReplied().
+post/postresult do the same without suspending, for programs that would rather poll.
+Values go over the network as 64 bit ints, and a message with anything larger fails on its own
+with INVALID_MESSAGE, as does an empty message over the text protocol.
+
+Connecting happens on a background thread, and after a failed attempt or a lost connection the
+next one waits twice as long as the last, up to maxBackoff. Messages that arrive go into a queue of
+at most maxQueue, and when it is full the overflow policy decides: DROP_OLDEST or DROP_NEWEST lose a
+message and the next recv pushes MESSAGES_DROPPED to say so, WAIT stops reading from the server
+until recv makes room. While a message is waiting on its return code WAIT keeps reading, so the
+code can't get stuck behind a few messages, and sets aside up to another maxQueue of what arrives
+until there is room. Past that it stops reading after all, and the code waits for recv too.
+"""
+import asyncio
+import collections
+import enum
+import select
+import socket
+import struct
+import threading
+import time
+
+import froth
+
+
+class NetworkErrors(enum.IntEnum):
+    SUCCESS = -1
+    DESTINATION_DOESNT_EXIST = -2
+    NO_DATA_AVAILABLE = -3
+    MESSAGES_DROPPED = -4
+    INVALID_MESSAGE = -5
+
+    NETWORK_ERROR = -99
+
+
+FRAME = struct.Struct("<IB")
+MESSAGE = 0
+CODE = 1
+# larger frames or lines are taken to mean the connection is broken
+MAX_FRAME = 1 << 24
+# what a value has to fit in to go over the network
+INT64 = range(-1 << 63, 1 << 63)
+
+# what Network does with a message that arrives when its queue is full
+DROP_OLDEST = "oldest"
+DROP_NEWEST = "newest"
+WAIT = "wait"
+
+
+def encodeFrame(kind, values):
+    return FRAME.pack(len(values) * 8, kind) + struct.pack(f"<{len(values)}q", *values)
+
+
+def readFrame(buf, pos):
+    "(kind, values, end) for the frame at buf[pos], None until all of it has arrived"
+    if len(buf) - pos < FRAME.size:
+        return None
+    length, kind = FRAME.unpack_from(buf, pos)
+    if length % 8 or length > MAX_FRAME:
+        raise ValueError(f"bad frame length {length}")
+    end = pos + FRAME.size + length
+    if len(buf) < end:
+        return None
+    return kind, struct.unpack_from(f"<{length // 8}q", buf, pos + FRAME.size), end
+
+
+def readLine(buf, pos):
+    "(words, end) for the line at buf[pos], None until all of it has arrived"
+    end = buf.find(b"\n", pos)
+    if end < 0:
+        if len(buf) - pos > MAX_FRAME:
+            raise ValueError("line too long")
+        return None
+    return buf[pos:end].split(), end + 1
+
+
+class DummyNet(object):
+    def recv(self, vm):
+        "( -- ...data sender length/err )"
+        pass
+
+    def send(self, vm):
+        "( ...data length target -- returnCode )"
+        pass
+
+    def recvn(self, vm):
+        "( max -- ...messages count/err ) each message being ...data sender length"
+        pass
+
+    def recvmem(self, vm):
+        "( address size -- count/err ) messages are written one after another as length sender ...data"
+        pass
+
+    def sendmany(self, vm):
+        "( ...data length ...targets count -- ...returnCodes ) one return code per target, in order"
+        pass
+
+    def post(self, vm):
+        "( ...data length target -- seq )"
+        pass
+
+    def postresult(self, vm):
+        "( seq -- returnCode )"
+        pass
+
+    def tick(self):
+        pass
+
+
+class Reply(object):
+    """What send and sendmany hand their VM to wait on: the return codes of some messages.
+    Hosts either poll it with resumeIfReplied() or await it, e.g. under frothasync; either way
+    something has to keep ticking the network meanwhile"""
+    def __init__(self, network, vm, *seqs):
+        self.network = network
+        self.vm = vm
+        self.seqs = seqs
+
+    def __await__(self):
+        for seq in self.seqs:
+            if seq not in self.network.codes:
+                # resolved by the network's tick() once the code is in
+                future = self.network.waiters[seq] = asyncio.get_running_loop().create_future()
+                yield from future.__await__()
+        self.finish(self.vm)
+
+    def done(self):
+        return all(seq in self.network.codes for seq in self.seqs)
+
+    def finish(self, vm):
+        "Push the return codes, after which the vm can be resumed"
+        vm.stack += [self.network.codes.pop(seq) for seq in self.seqs]
+
+
+class Network(object):
+    def __init__(self, conn: str, key: str, binary=False, maxQueue=1024, overflow=DROP_OLDEST,
+                 backoff=0.5, maxBackoff=30):
+        if overflow not in (DROP_OLDEST, DROP_NEWEST, WAIT):
+            raise ValueError(f"unknown overflow policy {overflow}")
+        self.sock = None
+        self.queue = collections.deque()
+        # messages that arrived with the queue full under WAIT, about maxQueue at most
+        self.held = collections.deque()
+        self.host, self.port = conn.split(":")
+        self.key = key
+        self.binary = binary
+        self.maxQueue = maxQueue
+        self.overflow = overflow
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        # seconds to wait before the next connection attempt
+        self.delay = 0
+        # the background connection attempt, and the socket it made if it worked
+        self.attempt = None
+        self.opened = None
+
+        # counters
+        self.received = 0
+        self.dropped = 0
+        self.sent = 0
+        self.reconnects = 0
+        # whether the next recv should report dropped messages
+        self.overflowed = False
+        self.closed = False
+
+        self.id = ""
+
+        # received data not parsed yet
+        self.inbuf = bytearray()
+        # encoded data waiting for tick() to send it
+        self.outbuf = bytearray()
+        # (seq, target, data) not encoded yet, held back until the server has said which protocol it speaks
+        self.outgoing = collections.deque()
+        # sequence ids of messages sent but without a return code yet, oldest first
+        self.inflight = collections.deque()
+        # sequence id -> return code
+        self.codes = {}
+        # sequence id -> future of a Reply being awaited on it
+        self.waiters = {}
+        self.seq = 0
+        self.connect()
+
+    def connect(self):
+        "Drop the connection and start making a new one in the background"
+        self.failPending()
+        self.outbuf.clear()
+        self.inbuf.clear()
+        self.id = ""
+        # "text", "binary", or None until the server answers a request for binary
+        self.mode = None if self.binary else "text"
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if self.attempt is not None:
+            self.reconnects += 1
+        self.attempt = threading.Thread(target=self.open, args=(self.delay, ), daemon=True)
+        self.attempt.start()
+        self.delay = min(max(self.delay * 2, self.backoff), self.maxBackoff)
+
+    def open(self, delay):
+        "Runs on the attempt's thread, tick() picks up the socket when it is done"
+        time.sleep(delay)
+        try:
+            sock = socket.create_connection((self.host, int(self.port)), timeout=10)
+            sock.setblocking(False)
+        except OSError:
+            sock = None
+        self.opened = sock
+        # close() may have run meanwhile, in which case nobody is going to pick the socket up
+        if self.closed and sock is not None:
+            sock.close()
+            self.opened = None
+
+    def failPending(self):
+        "Anything still waiting on the connection won't hear back"
+        while self.inflight:
+            self.resolve(self.inflight.popleft(), NetworkErrors.NETWORK_ERROR.value)
+        while self.outgoing:
+            self.resolve(self.outgoing.popleft()[0], NetworkErrors.NETWORK_ERROR.value)
+
+    def connected(self):
+        return self.sock is not None
+
+    def close(self):
+        "Disconnect for good"
+        self.closed = True
+        self.failPending()
+        for sock in (self.sock, self.opened):
+            if sock is not None:
+                sock.close()
+        self.sock = self.opened = None
+
+    def tick(self):
+        if self.closed:
+            return
+        if self.sock is None:
+            if self.attempt.is_alive():
+                return
+            sock, self.opened = self.opened, None
+            if sock is None:
+                self.connect()
+                return
+            self.sock = sock
+            self.Send(self.key)
+            if self.binary:
+                self.Send("binary")
+        try:
+            self.flush()
+            while self.held and len(self.queue) < self.maxQueue:
+                self.queue.append(self.held.popleft())
+            if self.overflow == WAIT and len(self.queue) >= self.maxQueue and (
+                    not self.inflight or len(self.held) >= self.maxQueue):
+                # leave it with the server until recv makes room
+                return
+            sel = select.select((self.sock, ), (), (), 0)[0]
+            if not sel: return
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError("connection closed")
+            self.inbuf += data
+            self.parse()
+
+        except Exception:
+            self.connect()
+
+    def parse(self):
+        "Handle every complete line or frame in inbuf, then drop them from it in one go"
+        buf = self.inbuf
+        pos = 0
+        while True:
+            if self.mode == "binary":
+                frame = readFrame(buf, pos)
+                if frame is None:
+                    break
+                kind, values, pos = frame
+                if kind == CODE:
+                    seq, code = values
+                    if seq in self.inflight:
+                        self.inflight.remove(seq)
+                        self.resolve(seq, code)
+                else:
+                    stack = list(values[1:])
+                    stack.append(values[0])
+                    stack.append(len(values) - 1)
+                    self.enqueue(stack)
+                continue
+
+            line = readLine(buf, pos)
+            if line is None:
+                break
+            line, pos = line
+            if not line:
+                continue
+            if len(line) == 1:
+                # our id, the answer to asking for binary, then a return code for each message
+                if not self.id:
+                    self.id = int(line[0])
+                    # connected, so the next time something goes wrong start backing off afresh
+                    self.delay = 0
+                elif self.mode is None:
+                    self.mode = "binary" if line[0] == b"binary" else "text"
+                elif self.inflight:
+                    self.resolve(self.inflight.popleft(), int(line[0]))
+                continue
+            sender = int(line[0])
+            stack = map(int, line[1:])
+            stack = list(stack)
+            length = len(stack)
+
+            stack.append(sender)
+            stack.append(length)
+            self.enqueue(stack)
+        del buf[:pos]
+
+    def resolve(self, seq, code):
+        self.codes[seq] = code
+        future = self.waiters.pop(seq, None)
+        if future is not None and not future.done():
+            future.set_result(code)
+
+    def enqueue(self, stack):
+        self.received += 1
+        if self.overflow == WAIT:
+            if self.held or len(self.queue) >= self.maxQueue:
+                self.held.append(stack)
+                return
+        elif len(self.queue) >= self.maxQueue:
+            self.dropped += 1
+            self.overflowed = True
+            if self.overflow == DROP_NEWEST:
+                return
+            self.queue.popleft()
+        self.queue.append(stack)
+
+    def flush(self):
+        "Write out as much of the queued messages as the socket takes without blocking"
+        if self.mode is not None:
+            # sendmany queues the same data for every target, which only needs encoding once
+            last = encoded = None
+            while self.outgoing:
+                seq, target, data = self.outgoing.popleft()
+                if not data and self.mode == "text":
+                    # a line with just the target would reach them as a lone sender id, which reads as a return code
+                    self.resolve(seq, NetworkErrors.INVALID_MESSAGE.value)
+                    continue
+                if self.mode == "binary":
+                    if data is not last:
+                        last, encoded = data, struct.pack(f"<{len(data)}q", *data)
+                    self.outbuf += FRAME.pack(len(data) * 8 + 16, MESSAGE)
+                    self.outbuf += struct.pack("<qq", seq, target)
+                else:
+                    if data is not last:
+                        last, encoded = data, (" ".join(map(str, data)) + "\n").encode("utf8")
+                    self.outbuf += b"%d " % target
+                self.outbuf += encoded
+                self.inflight.append(seq)
+                self.sent += 1
+        if not self.outbuf:
+            return
+        try:
+            sent = self.sock.send(self.outbuf)
+        except BlockingIOError:
+            return
+        del self.outbuf[:sent]
+
+    def recv(self, vm):
+        "( -- ...data sender length/err )"
+        if self.overflowed:
+            self.overflowed = False
+            vm.stack.append(NetworkErrors.MESSAGES_DROPPED.value)
+            return
+        if not self.queue:
+            vm.stack.append(NetworkErrors.NO_DATA_AVAILABLE.value)
+            return
+        vm.stack += self.queue.popleft()
+
+    def recvn(self, vm):
+        "( max -- ...messages count/err ) each message being ...data sender length"
+        most = vm.stack.pop()
+        if self.overflowed:
+            self.overflowed = False
+            vm.stack.append(NetworkErrors.MESSAGES_DROPPED.value)
+            return
+        count = min(most, len(self.queue))
+        for _ in range(count):
+            vm.stack += self.queue.popleft()
+        vm.stack.append(max(count, 0))
+
+    def recvmem(self, vm):
+        """( address size -- count/err ) messages are written one after another as length sender ...data.
+        Messages too long for the whole region are dropped, and reported like an overflow"""
+        size = vm.stack.pop()
+        address = vm.stack.pop()
+        if address < 0 or size < 0 or address + size > len(vm.memory):
+            return froth.Errors.MEMORY_ERROR
+        if self.overflowed:
+            self.overflowed = False
+            vm.stack.append(NetworkErrors.MESSAGES_DROPPED.value)
+            return
+        count = 0
+        end = address + size
+        while self.queue:
+            if len(self.queue[0]) > size:
+                # would never fit, so it is dropped rather than holding up everything behind it
+                self.queue.popleft()
+                self.dropped += 1
+                self.overflowed = True
+                continue
+            if address + len(self.queue[0]) > end:
+                break
+            message = self.queue.popleft()
+            # stored the other way round from the stack, so the length comes first
+            vm.memory.write(address, [message[-1], message[-2]] + message[:-2])
+            address += len(message)
+            count += 1
+        vm.stack.append(count)
+
+    def queueMessage(self, vm):
+        "Take a message off the stack and queue it, returning its sequence id"
+        target = vm.stack.pop()
+        length = vm.stack.pop()
+        if length > len(vm.stack):
+            raise IndexError(length)
+        data = vm.stack[len(vm.stack) - length:]
+        del vm.stack[len(vm.stack) - length:]
+        self.seq += 1
+        if target in INT64 and all(value in INT64 for value in data):
+            self.outgoing.append((self.seq, target, data))
+        else:
+            # fails on its own rather than breaking the connection when it is encoded
+            self.resolve(self.seq, NetworkErrors.INVALID_MESSAGE.value)
+        return self.seq
+
+    def send(self, vm):
+        "( ...data length target -- returnCode )"
+        return Reply(self, vm, self.queueMessage(vm))
+
+    def sendmany(self, vm):
+        "( ...data length ...targets count -- ...returnCodes ) one return code per target, in order"
+        count = vm.stack.pop()
+        if count < 0 or count >= len(vm.stack):
+            raise IndexError(count)
+        targets = vm.stack[len(vm.stack) - count:]
+        del vm.stack[len(vm.stack) - count:]
+        length = vm.stack.pop()
+        if length > len(vm.stack):
+            raise IndexError(length)
+        data = vm.stack[len(vm.stack) - length:]
+        del vm.stack[len(vm.stack) - length:]
+        seqs = range(self.seq + 1, self.seq + 1 + count)
+        self.seq += count
+        valid = all(value in INT64 for value in data)
+        for seq, target in zip(seqs, targets):
+            if valid and target in INT64:
+                self.outgoing.append((seq, target, data))
+            else:
+                self.resolve(seq, NetworkErrors.INVALID_MESSAGE.value)
+        return Reply(self, vm, *seqs)
+
+    def post(self, vm):
+        "( ...data length target -- seq )"
+        vm.stack.append(self.queueMessage(vm))
+
+    def postresult(self, vm):
+        "( seq -- returnCode )"
+        vm.stack.append(self.codes.pop(vm.stack.pop(), NetworkErrors.NO_DATA_AVAILABLE.value))
+
+    def Send(self, data):
+        self.outbuf += b"%s\n" % data.encode("utf8")
+
+
+def resumeIfReplied(vm):
+    "For hosts: finish a send the vm is waiting on if its return code is back, returns whether it did"
+    reply = vm.awaiting
+    if isinstance(reply, Reply) and reply.done():
+        reply.finish(vm)
+        vm.resume(None)
+        return True
+    return False
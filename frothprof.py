@@ -0,0 +1,137 @@
+"""Opt-in profiler for froth VMs.
+
+    profiler = Profiler()
+    vm = profiler.attach(froth.VM(code))
+    vm.runUntilEnd()
+    print(profiler.report())
+    open("froth.folded", "w").write(profiler.collapsed())
+
+attach() has that one VM run its ops through a timing hook, see VM.exec, so VMs without a
+profiler run exactly the code they always did. It records call counts and time per word, per
+macro (inclusive of everything the macro runs, in wall time) and per source line, along with the
+deepest the stack and the largest memory got. collapsed() is in the folded format flamegraph.pl and speedscope
+read, with nanoseconds as the sample values.
+"""
+import functools
+import time
+
+import froth
+
+
+class Profiler(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # name -> [calls, nanoseconds]
+        self.words = {}
+        self.macros = {}
+        # pc -> [times run, nanoseconds]
+        self.lines = {}
+        # (pc, macros..., word) -> nanoseconds
+        self.stacks = {}
+        self.maxStack = 0
+        self.maxMemory = 0
+
+    def attach(self, vm):
+        "Profile everything vm runs from now on, returns vm"
+        if "exec" in vm.__dict__:
+            raise ValueError("vm already has a tracer or profiler attached")
+        # the macro frames entered so far on the current line, kept across yields
+        vm.exec = functools.partial(self.exec, vm, [])
+        return vm
+
+    def detach(self, vm):
+        vm.__dict__.pop("exec", None)
+
+    def exec(self, vm, owners):
+        "VM.exec, timing every op"
+        if not vm.budget:
+            return froth.Errors.YIELD
+        frames = vm.frames
+        clock = time.perf_counter_ns
+        pc = vm.pc
+        lineStart = clock()
+        # the macros running, as of the last op
+        path = [self.sync(frames, owners, None, lineStart)]
+
+        def run(vm, func, args, source):
+            if len(frames) != len(owners) or frames[-1] is not owners[-1][0]:
+                # frames read to their end since the last op
+                path[0] = self.sync(frames, owners, None, clock())
+            start = clock()
+            try:
+                return func(vm, *args)
+            finally:
+                now = clock()
+                self.record(pc, path[0], label((func, args, source)), now - start)
+                self.maxStack = max(self.maxStack, len(vm.stack))
+                self.maxMemory = max(self.maxMemory, len(vm.memory))
+                if len(frames) != len(owners) or frames[-1] is not owners[-1][0]:
+                    path[0] = self.sync(frames, owners, str(source[0]) if func is froth.VM.opLoad else None, now)
+
+        return self.finish(owners, pc, lineStart, froth.VM.exec(vm, run))
+
+    def finish(self, owners, pc, lineStart, ret):
+        end = time.perf_counter_ns()
+        if ret is not froth.Errors.YIELD:
+            # the line is over however it ended
+            self.sync([], owners, None, end)
+        stat = self.lines.setdefault(pc, [0, 0])
+        stat[0] += ret is not froth.Errors.YIELD
+        stat[1] += end - lineStart
+        return ret
+
+    def sync(self, frames, owners, name, now):
+        """Match owners up with frames: macros whose frames are gone have finished, new frames were
+        entered by name (None for if bodies and the like). Returns the macro names now running"""
+        keep = 0
+        while keep < len(owners) and keep < len(frames) and owners[keep][0] is frames[keep]:
+            keep += 1
+        for frame, finished, start in owners[keep:]:
+            if finished is not None:
+                self.macros[finished][1] += now - start
+        del owners[keep:]
+        for frame in frames[keep:]:
+            owners.append((frame, name, now))
+            if name is not None:
+                self.macros.setdefault(name, [0, 0])[0] += 1
+        return tuple(owner[1] for owner in owners if owner[1] is not None)
+
+    def record(self, pc, path, name, elapsed):
+        stat = self.words.setdefault(name, [0, 0])
+        stat[0] += 1
+        stat[1] += elapsed
+        key = (pc,) + path + (name,)
+        self.stacks[key] = self.stacks.get(key, 0) + elapsed
+
+    def report(self, sort="time", limit=20):
+        "The hottest words, macros and lines as a text table, sorted by time or calls"
+        column = {"time": 1, "calls": 0}[sort]
+        out = [f"max stack depth {self.maxStack}, max memory {self.maxMemory} cells"]
+        for title, stats in (("word", self.words), ("macro", self.macros),
+                             ("line", {f"line {pc}": stat for pc, stat in self.lines.items()})):
+            out.append("")
+            out.append(f"{title:24} {'calls':>10} {'total ms':>10} {'per call us':>12}")
+            rows = sorted(stats.items(), key=lambda item: item[1][column], reverse=True)
+            for name, (calls, ns) in rows[:limit]:
+                out.append(f"{name:24} {calls:10} {ns / 1e6:10.3f} {ns / 1e3 / max(calls, 1):12.3f}")
+        return "\n".join(out) + "\n"
+
+    def collapsed(self):
+        "Folded stacks, one `line N;macro;...;word nanoseconds` per line"
+        return "".join(f"line {key[0]};{';'.join(key[1:])} {ns}\n" for key, ns in sorted(self.stacks.items()))
+
+
+# ops standing in for several words, see VM.optimize()
+FUSED = froth.LITERAL_FUNCS | set(froth.PAIRS.values()) | {froth.VM.opNonZero, froth.VM.opDupVar}
+
+
+def label(op):
+    "The name an op is counted under: its word, the words a fused op stands for, or (literal)"
+    func, args, source = op
+    if func is froth.VM.opPush:
+        return "(literal)"
+    if func in FUSED:
+        return " ".join(map(str, source))
+    return str(source[0])
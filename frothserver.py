@@ -0,0 +1,172 @@
+"""A relay server for the froth network protocol, see frothnet.
+
+    python frothserver.py --port 1234 --key secret
+
+Clients send the key, get an id back, and from then on every message they send is passed on to
+the client with the target id, with a return code back to the sender: SUCCESS, or
+DESTINATION_DOESNT_EXIST if nobody has that id. Clients asking for the binary protocol get it,
+text and binary clients can message each other, except that an empty message to a text client
+and a value that doesn't fit in 64 bits for a binary one fail with INVALID_MESSAGE.
+
+Every client has a bounded queue of data waiting to be written to it. When a target's queue is
+full, reading from the sender waits until there is room, so a client that stops reading slows
+down whoever is flooding it instead of the server buffering without limit.
+"""
+import argparse
+import asyncio
+import itertools
+import struct
+
+import frothnet
+from frothnet import NetworkErrors
+
+
+class Client(object):
+    def __init__(self, id, writer, queueSize):
+        self.id = id
+        self.writer = writer
+        self.binary = False
+        # encoded data waiting to be written
+        self.queue = asyncio.Queue(queueSize)
+        # set once the client has gone, waking anyone waiting for room in its queue
+        self.closed = asyncio.Event()
+
+    async def put(self, data):
+        "Queue data to be written, waiting for room. Returns False if the client goes away first"
+        if self.closed.is_set():
+            return False
+        if not self.queue.full():
+            self.queue.put_nowait(data)
+            return True
+        put = asyncio.ensure_future(self.queue.put(data))
+        closed = asyncio.ensure_future(self.closed.wait())
+        await asyncio.wait((put, closed), return_when=asyncio.FIRST_COMPLETED)
+        closed.cancel()
+        if not put.done():
+            put.cancel()
+            return False
+        return True
+
+    def encodeMessage(self, sender, data):
+        if self.binary:
+            return frothnet.encodeFrame(frothnet.MESSAGE, [sender] + data)
+        return b"%d %s\n" % (sender, " ".join(map(str, data)).encode())
+
+    def encodeCode(self, seq, code):
+        if self.binary:
+            return frothnet.encodeFrame(frothnet.CODE, [seq, code])
+        return b"%d\n" % code
+
+    async def writeLoop(self):
+        "Write queued data out, everything that has piled up in one go"
+        while True:
+            chunks = [await self.queue.get()]
+            while not self.queue.empty():
+                chunks.append(self.queue.get_nowait())
+            self.writer.write(b"".join(chunks))
+            await self.writer.drain()
+
+
+class Server(object):
+    def __init__(self, key, queueSize=1024):
+        self.key = key
+        self.queueSize = queueSize
+        # id -> Client
+        self.clients = {}
+        self.ids = itertools.count(1)
+        self.relayed = 0
+
+    async def start(self, host="127.0.0.1", port=0):
+        "Start listening, returns the asyncio.Server; port 0 picks a free one"
+        return await asyncio.start_server(self.handle, host, port, limit=frothnet.MAX_FRAME)
+
+    async def serve(self, host="127.0.0.1", port=0):
+        server = await self.start(host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        client = None
+        try:
+            if (await reader.readline()).strip() != self.key.encode("utf8"):
+                return
+            client = Client(next(self.ids), writer, self.queueSize)
+            self.clients[client.id] = client
+            writer.write(b"%d\n" % client.id)
+            task = asyncio.ensure_future(client.writeLoop())
+            try:
+                await self.readLoop(client, reader)
+            finally:
+                task.cancel()
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            if client is not None:
+                del self.clients[client.id]
+                client.closed.set()
+            writer.close()
+
+    async def readLoop(self, client, reader):
+        line = await reader.readline()
+        if line.strip() == b"binary":
+            await client.put(b"binary\n")
+            client.binary = True
+        else:
+            if not line:
+                return
+            await self.textMessage(client, line)
+        while True:
+            if client.binary:
+                length, kind = frothnet.FRAME.unpack(await reader.readexactly(frothnet.FRAME.size))
+                if kind != frothnet.MESSAGE or length % 8 or not 16 <= length <= frothnet.MAX_FRAME:
+                    raise ValueError("bad frame")
+                seq, target, *data = struct.unpack(f"<{length // 8}q", await reader.readexactly(length))
+                await self.relay(client, seq, target, data)
+            else:
+                line = await reader.readline()
+                if not line:
+                    return
+                await self.textMessage(client, line)
+
+    async def textMessage(self, client, line):
+        words = line.split()
+        if words:
+            await self.relay(client, None, int(words[0]), [int(word) for word in words[1:]])
+
+    async def relay(self, sender, seq, target, data):
+        destination = self.clients.get(target)
+        if destination is None:
+            code = NetworkErrors.DESTINATION_DOESNT_EXIST
+        elif not data and not destination.binary:
+            # the line would be just the sender id, which a text client reads as a return code
+            code = NetworkErrors.INVALID_MESSAGE
+        else:
+            try:
+                encoded = destination.encodeMessage(sender.id, data)
+            except struct.error:
+                # a text client sent a value too large for a binary frame
+                code = NetworkErrors.INVALID_MESSAGE
+            else:
+                if await destination.put(encoded):
+                    code = NetworkErrors.SUCCESS
+                    self.relayed += 1
+                else:
+                    code = NetworkErrors.DESTINATION_DOESNT_EXIST
+        await sender.put(sender.encodeCode(seq, code.value))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Relay messages between froth clients")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1234)
+    parser.add_argument("--key", required=True)
+    parser.add_argument("--queue", type=int, default=1024, help="chunks buffered per client before senders wait")
+    args = parser.parse_args()
+    try:
+        asyncio.run(Server(args.key, args.queue).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,17 @@
 import froth
+import frothasync
+import frothprof
+import frothtrace
+import frothnet
+import frothserver
+import asyncio
+import frothbatch
+import io
+import os
+import tempfile
+import contextlib
+import socket
+import time
 
 BASICS = """
 1 1 1
@@ -88,6 +101,715 @@ assert vm.stack == [85, 10, 5]
 
 print("PASSED MEMORY TESTS")
 
+MEMORY_BOUNDS = """
+MEMORY_ERROR -1 catch
+4 alloc
+-1 memread
+4 memread
+3 99 memwrite 3 memread
+0 dealloc here
+-2 alloc here
+10 dealloc here
+"""
+
+vm = froth.VM(MEMORY_BOUNDS)
+end = vm.runUntilEnd()
+assert end == froth.Errors.END_OF_PROGRAM
+assert vm.stack == [99, 4, 0]
+
+print("PASSED MEMORY BOUNDS TESTS")
+
+BULK_MEMORY = """
+8 alloc
+0 4 7 memfill
+1 2 3 2 3 memstore
+2 5 3 memcopy
+0 8 memload
+MEMORY_ERROR -1 catch
+6 0 3 memcopy
+"""
+
+vm = froth.VM(BULK_MEMORY)
+end = vm.runUntilEnd()
+assert end == froth.Errors.END_OF_PROGRAM
+assert vm.stack == [7, 7, 1, 2, 3, 1, 2, 3]
+assert list(vm.memory) == [7, 7, 1, 2, 3, 1, 2, 3]
+
+vm = froth.VM("\n4 alloc 1 2 0 -2 memstore\n")
+assert vm.runUntilEnd() == froth.Errors.MEMORY_ERROR
+assert vm.stack == [1, 2]
+
+print("PASSED BULK MEMORY TESTS")
+
+with tempfile.TemporaryDirectory() as tmp:
+    path = os.path.join(tmp, "memory")
+    vm = froth.VM(BULK_MEMORY, memoryFile=path)
+    end = vm.runUntilEnd()
+    assert end == froth.Errors.END_OF_PROGRAM
+    assert vm.stack == [7, 7, 1, 2, 3, 1, 2, 3]
+    vm.memory.close()
+    assert os.path.getsize(path) == 8 * 8
+
+    vm = froth.VM("\nhere 2 memread 3 dealloc here\n", memoryFile=path)
+    end = vm.runUntilEnd()
+    assert end == froth.Errors.END_OF_PROGRAM
+    assert vm.stack == [8, 1, 5]
+    vm.memory.close()
+
+print("PASSED MAPPED MEMORY TESTS")
+
+OUTPUT = """
+"hi" drop emit emit 42 p
+flush
+cr 7 p
+"""
+out = io.StringIO()
+vm = froth.VM(OUTPUT, output=out)
+assert vm.tick() == froth.Errors.SUCCESS
+assert vm.tick() == froth.Errors.SUCCESS
+assert out.getvalue() == ""
+assert vm.tick() == froth.Errors.SUCCESS
+assert out.getvalue() == "hi42"
+assert vm.runUntilEnd() == froth.Errors.END_OF_PROGRAM
+assert out.getvalue() == "hi42\n7"
+
+out = io.StringIO()
+vm = froth.VM(OUTPUT, output=out, lineBuffered=True)
+vm.tick(), vm.tick(), vm.tick(), vm.tick()
+assert out.getvalue() == "hi42\n"
+
+print("PASSED OUTPUT TESTS")
+
+with tempfile.TemporaryDirectory() as tmp:
+    good = os.path.join(tmp, "good.froth")
+    bad = os.path.join(tmp, "bad.froth")
+    with open(good, "w") as f:
+        f.write(BASICS + "add add add add p cr\n")
+    with open(bad, "w") as f:
+        f.write("\n35 raise\n")
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(io.StringIO()):
+        assert froth.main(["run", good]) == 0
+        assert froth.main(["run", bad, good]) == 35
+    assert out.getvalue() == "7\n7\n"
+
+print("PASSED CLI TESTS")
+
+result = frothbatch.runProgram(BASICS + "add p\n")
+assert result.stack == [1, 1, 1]
+assert result.output == "4"
+assert result.errorName == "END_OF_PROGRAM"
+
+result = frothbatch.runProgram("\n1 line jump\n", maxSteps=60)
+assert result.error == froth.Errors.TIMEOUT
+assert result.stack == [1] * 20
+
+result = frothbatch.runProgram("\nmacro forever forever ;\nforever\n", timeout=0.05)
+assert result.error == froth.Errors.TIMEOUT
+
+result = frothbatch.runProgram("\ncustom\n", customWords=lambda: {"custom": (lambda vm: vm.stack.append(50), 0)})
+assert result.stack == [50]
+
+result = frothbatch.runProgram("\n1 2 3 p\n0 7 mod\n")
+assert result.error is None and result.errorName.startswith("EXCEPTION: ZeroDivisionError")
+assert result.stack == [1, 2] and result.pc == 2
+assert result.output == "3"
+
+results = frothbatch.runBatch(["\n1 2 add\n", "\n0 7 mod\n"], workers=2)
+assert results[0].stack == [3] and results[1].errorName.startswith("EXCEPTION")
+
+print("PASSED BATCH TESTS")
+
+STEPS = """
+1 2 3 4 5 6
+line 1 add jump
+7 8 9
+"""
+vm = froth.VM(STEPS)
+assert vm.run(steps=4) == froth.Errors.YIELD
+assert vm.stack == [1, 2, 3, 4]
+assert vm.run(steps=2) == froth.Errors.YIELD
+assert vm.stack == [1, 2, 3, 4, 5, 6]
+assert vm.pc == 1
+assert vm.tick() == froth.Errors.SUCCESS
+assert vm.pc == 2
+assert vm.run() == froth.Errors.END_OF_PROGRAM
+assert vm.stack == [1, 2, 3, 4, 5, 6, 7, 8, 9]
+
+vm = froth.VM("\nSTACK_UNDERFLOW -1 catch\ndrop drop 1\n2\n")
+assert vm.run(steps=3) == froth.Errors.YIELD
+assert vm.stack == []
+assert vm.run() == froth.Errors.END_OF_PROGRAM
+assert vm.stack == [2]
+
+print("PASSED STEP BUDGET TESTS")
+
+SNAPSHOT = """
+macro square dup mul ;
+4 alloc 2 5 memwrite
+3 var x "ab" x square
+MEMORY_ERROR -1 catch
+x 1 add dup var x 10 lt if line 1 sub jump ; 9 var 8 8 p
+"""
+expected = froth.VM(SNAPSHOT, output=io.StringIO())
+assert expected.runUntilEnd() == froth.Errors.END_OF_PROGRAM
+for steps in (1, 7, 12, 40):
+    vm = froth.VM(SNAPSHOT, output=io.StringIO())
+    assert vm.run(steps=steps) == froth.Errors.YIELD
+    clone = vm.clone(output=io.StringIO())
+    out = io.StringIO()
+    vm = froth.VM.restore(vm.snapshot(), output=out)
+    for copy in (vm, clone):
+        assert copy.runUntilEnd() == froth.Errors.END_OF_PROGRAM
+        assert copy.stack == expected.stack
+        assert copy.variables == expected.variables
+        assert list(copy.memory) == list(expected.memory)
+    assert out.getvalue() == "9"
+
+print("PASSED SNAPSHOT TESTS")
+
+profiler = frothprof.Profiler()
+vm = profiler.attach(froth.VM(MACRO))
+assert vm.run(steps=7) == froth.Errors.YIELD
+assert vm.runUntilEnd() == froth.Errors.END_OF_PROGRAM
+assert vm.stack == [1, 2, 5, 4, 3, 2, 1]
+assert profiler.macros["dec"][0] == 5 and profiler.macros["two"][0] == 1
+assert profiler.words["jump"][0] == 4
+assert profiler.lines[9][0] == 5
+assert profiler.maxStack == 8
+assert "line 10;dec;1 sub " in profiler.collapsed()
+assert "dec" in profiler.report(sort="calls")
+assert "exec" not in vm.clone().__dict__
+
+profiler = frothprof.Profiler()
+vm = profiler.attach(froth.VM("\nSTACK_UNDERFLOW -1 catch\nmacro m drop ; m\n4 alloc 1\n"))
+assert vm.runUntilEnd() == froth.Errors.END_OF_PROGRAM
+assert vm.stack == [1]
+assert profiler.maxMemory == 4
+assert profiler.words["m"][0] == 1 and profiler.macros["m"][0] == 1
+
+print("PASSED PROFILER TESTS")
+
+class Recorder(frothtrace.Tracer):
+    def __init__(self):
+        self.events = []
+
+    def line(self, vm):
+        self.events.append(("line", vm.pc))
+
+    def error(self, vm, ret):
+        self.events.append(("error", ret))
+
+    def catch(self, vm, ret, line):
+        self.events.append(("catch", ret, line))
+
+    def memoryWrite(self, vm, address, size):
+        self.events.append(("write", address, size))
+
+    def debug(self, vm):
+        self.events.append(("debug", list(vm.stack)))
+
+TRACED = """
+STACK_UNDERFLOW 5 catch
+4 alloc 1 7 memwrite 0 2 9 memfill
+
+debug drop
+5 debug 3 raise
+"""
+recorder = Recorder()
+out = io.StringIO()
+vm = frothtrace.attach(froth.VM(TRACED, output=out), recorder)
+assert vm.runUntilEnd().name == "USER_ERROR_3"
+assert recorder.events[:-1] == [("line", 1), ("line", 2), ("write", 1, 1), ("write", 0, 2), ("line", 4),
+                                ("debug", []), ("catch", froth.Errors.STACK_UNDERFLOW, 5), ("line", 5),
+                                ("debug", [5])]
+assert recorder.events[-1][0] == "error" and recorder.events[-1][1].name == "USER_ERROR_3"
+assert out.getvalue() == ""
+assert list(vm.memory) == [9, 9, 0, 0]
+
+class WordCounter(frothtrace.Tracer):
+    words = 0
+
+    def word(self, vm, op):
+        self.words += 1
+
+counter = WordCounter()
+vm = frothtrace.attach(froth.VM(MACRO), counter, every=2)
+assert vm.run(steps=5) == froth.Errors.YIELD
+assert vm.runUntilEnd() == froth.Errors.END_OF_PROGRAM
+assert vm.stack == [1, 2, 5, 4, 3, 2, 1]
+plain = froth.VM(MACRO)
+plain.budget = 1000
+while plain.tick() == froth.Errors.SUCCESS:
+    pass
+assert counter.words == (1000 - plain.budget) // 2
+try:
+    frothtrace.attach(vm, counter)
+    assert False
+except ValueError:
+    pass
+frothtrace.detach(vm)
+assert "exec" not in vars(vm)
+
+print("PASSED TRACE TESTS")
+
+def readLines(conn, count):
+    data = b""
+    while data.count(b"\n") < count:
+        data += conn.recv(4096)
+    return data.decode().split("\n")[:count]
+
+def tickUntil(network, done):
+    deadline = time.time() + 5
+    while not done():
+        assert time.time() < deadline
+        network.tick()
+        time.sleep(0.001)
+
+async def tickUntilAsync(done, *networks):
+    "tickUntil for tests running a relay server on the same event loop, which needs a chance to run"
+    deadline = time.time() + 5
+    while not done():
+        assert time.time() < deadline
+        for network in networks:
+            network.tick()
+        await asyncio.sleep(0.001)
+
+async def startRelay():
+    "(relay, asyncio server, address to connect to) for a relay server on a free port"
+    relay = frothserver.Server("secret")
+    server = await relay.start()
+    return relay, server, f"127.0.0.1:{server.sockets[0].getsockname()[1]}"
+
+with socket.create_server(("127.0.0.1", 0)) as server:
+    network = frothnet.Network(f"127.0.0.1:{server.getsockname()[1]}", "secret")
+    conn, _ = server.accept()
+    with conn:
+        # connecting happens in the background
+        tickUntil(network, network.connected)
+        network.tick()
+        assert readLines(conn, 1) == ["secret"]
+        conn.sendall(b"12\n")
+        tickUntil(network, lambda: network.id)
+        assert network.id == 12
+
+        words = {"send": (network.send, 0), "post": (network.post, 0), "postresult": (network.postresult, 0),
+                 "recv": (network.recv, 0)}
+        vm = froth.VM("\n5 6 2 7 send 8\n3 1 7 post 4 1 9 post\n", customWords=words)
+        assert vm.tick() == froth.Errors.SUCCESS
+        assert vm.tick() == froth.Errors.YIELD
+        assert not frothnet.resumeIfReplied(vm)
+        network.tick()
+        assert readLines(conn, 1) == ["7 5 6"]
+        conn.sendall(b"-1\n")
+        tickUntil(network, lambda: frothnet.resumeIfReplied(vm))
+        assert vm.runUntilEnd() == froth.Errors.END_OF_PROGRAM
+        assert vm.stack == [-1, 8, 2, 3]
+
+        network.tick()
+        assert readLines(conn, 2) == ["7 3", "9 4"]
+        conn.sendall(b"-1\n-2\n3 10 11\n")
+        tickUntil(network, lambda: network.queue)
+        vm = froth.VM("\n3 postresult 2 postresult 3 postresult recv\n", customWords=words)
+        assert vm.runUntilEnd() == froth.Errors.END_OF_PROGRAM
+        assert vm.stack == [-2, -1, frothnet.NetworkErrors.NO_DATA_AVAILABLE, 10, 11, 3, 2]
+
+        # an empty message can't go out as a line, it would look like a return code
+        vm = froth.VM("\n0 7 post 5 1 7 post\n", customWords=words)
+        assert vm.runUntilEnd() == froth.Errors.END_OF_PROGRAM
+        network.tick()
+        assert readLines(conn, 1) == ["7 5"]
+        assert network.codes == {4: frothnet.NetworkErrors.INVALID_MESSAGE}
+        assert list(network.inflight) == [5]
+
+print("PASSED NETWORK TESTS")
+
+def readFrames(conn, count):
+    data = bytearray()
+    frames = []
+    while len(frames) < count:
+        data += conn.recv(4096)
+        pos = 0
+        frames = []
+        while (frame := frothnet.readFrame(data, pos)) is not None:
+            frames.append(frame[:2])
+            pos = frame[2]
+    return frames
+
+frame = frothnet.encodeFrame(frothnet.MESSAGE, [3, -2, 1 << 40])
+assert frothnet.readFrame(frame, 0) == (frothnet.MESSAGE, (3, -2, 1 << 40), len(frame))
+assert frothnet.readFrame(frame[:-1], 0) is None
+assert frothnet.readFrame(bytearray(b"xx") + frame, 2)[1] == (3, -2, 1 << 40)
+assert frothnet.readLine(b"1 2\n3", 0) == ([b"1", b"2"], 4)
+assert frothnet.readLine(b"1 2\n3", 4) is None
+
+with socket.create_server(("127.0.0.1", 0)) as server:
+    network = frothnet.Network(f"127.0.0.1:{server.getsockname()[1]}", "secret", binary=True)
+    conn, _ = server.accept()
+    with conn:
+        # connecting happens in the background
+        tickUntil(network, network.connected)
+        network.tick()
+        assert readLines(conn, 2) == ["secret", "binary"]
+        words = {"send": (network.send, 0), "post": (network.post, 0), "postresult": (network.postresult, 0),
+                 "recv": (network.recv, 0)}
+        vm = froth.VM("\n5 6 2 7 post 4 1 9 post recv\n", customWords=words)
+        assert vm.runUntilEnd() == froth.Errors.END_OF_PROGRAM
+        # nothing goes out until the server has answered
+        network.tick()
+        assert network.outgoing and not network.outbuf
+
+        # a frame in the same packet as the hello, and one split across several
+        message = frothnet.encodeFrame(frothnet.MESSAGE, [3, 10, 11])
+        conn.sendall(b"12\nbinary\n" + message + frothnet.encodeFrame(frothnet.CODE, [2, -2])[:3])
+        tickUntil(network, lambda: network.queue)
+        assert network.mode == "binary" and network.id == 12
+        network.tick()
+        assert readFrames(conn, 2) == [(frothnet.MESSAGE, (1, 7, 5, 6)), (frothnet.MESSAGE, (2, 9, 4))]
+        conn.sendall(frothnet.encodeFrame(frothnet.CODE, [2, -2])[3:] + frothnet.encodeFrame(frothnet.CODE, [1, -1]))
+        tickUntil(network, lambda: len(network.codes) == 2)
+        assert not network.inbuf and not network.inflight
+
+        vm = froth.VM("\n2 postresult 1 postresult recv\n", customWords=words)
+        assert vm.runUntilEnd() == froth.Errors.END_OF_PROGRAM
+        assert vm.stack == [-2, -1, 10, 11, 3, 2]
+
+        # values that don't fit in 64 bits fail that message alone, the connection carries on
+        words["sendmany"] = (network.sendmany, 0)
+        vm = froth.VM("\n9223372036854775808 1 7 post 5 1 9223372036854775808 post 6 1 7 -1 2 sendmany\n",
+                      customWords=words)
+        assert vm.tick() == froth.Errors.SUCCESS
+        assert vm.tick() == froth.Errors.YIELD
+        assert network.codes == {3: frothnet.NetworkErrors.INVALID_MESSAGE, 4: frothnet.NetworkErrors.INVALID_MESSAGE}
+        network.tick()
+        assert readFrames(conn, 2) == [(frothnet.MESSAGE, (5, 7, 6)), (frothnet.MESSAGE, (6, -1, 6))]
+        assert network.connected()
+
+# a server that doesn't know about binary answers the request like any other message
+with socket.create_server(("127.0.0.1", 0)) as server:
+    network = frothnet.Network(f"127.0.0.1:{server.getsockname()[1]}", "secret", binary=True)
+    conn, _ = server.accept()
+    with conn:
+        # connecting happens in the background
+        tickUntil(network, network.connected)
+        network.tick()
+        assert readLines(conn, 2) == ["secret", "binary"]
+        conn.sendall(b"12\n-2\n")
+        tickUntil(network, lambda: network.mode)
+        assert network.mode == "text"
+        vm = froth.VM("\n5 1 7 post\n", customWords={"post": (network.post, 0)})
+        assert vm.runUntilEnd() == froth.Errors.END_OF_PROGRAM
+        network.tick()
+        assert readLines(conn, 1) == ["7 5"]
+        conn.sendall(b"-1\n")
+        tickUntil(network, lambda: network.codes)
+        assert network.codes == {1: -1}
+
+print("PASSED BINARY PROTOCOL TESTS")
+
+# nobody listening: each attempt waits twice as long as the last, up to maxBackoff
+with socket.create_server(("127.0.0.1", 0)) as server:
+    port = server.getsockname()[1]
+network = frothnet.Network(f"127.0.0.1:{port}", "secret", backoff=0.001, maxBackoff=0.004)
+delays = [network.delay]
+while network.reconnects < 4:
+    reconnects = network.reconnects
+    network.tick()
+    if network.reconnects != reconnects:
+        delays.append(network.delay)
+    time.sleep(0.001)
+assert delays == [0.001, 0.002, 0.004, 0.004, 0.004]
+assert not network.connected()
+network.close()
+
+# closing while an attempt is still connecting doesn't leave its socket open
+with socket.create_server(("127.0.0.1", 0)) as server:
+    network = frothnet.Network(f"127.0.0.1:{server.getsockname()[1]}", "secret")
+    # and fails what was still waiting to go out
+    vm = froth.VM("\n5 1 7 post\n", customWords={"post": (network.post, 0)})
+    assert vm.runUntilEnd() == froth.Errors.END_OF_PROGRAM
+    network.close()
+    assert network.codes == {1: frothnet.NetworkErrors.NETWORK_ERROR} and not network.outgoing
+    network.attempt.join()
+    assert network.opened is None and not network.connected()
+    conn, _ = server.accept()
+    with conn:
+        assert conn.recv(10) == b""
+
+with socket.create_server(("127.0.0.1", 0)) as server:
+    network = frothnet.Network(f"127.0.0.1:{server.getsockname()[1]}", "secret", maxQueue=2, backoff=0.01)
+    conn, _ = server.accept()
+    tickUntil(network, network.connected)
+    network.tick()
+    readLines(conn, 1)
+    conn.sendall(b"12\n1 1\n1 2\n1 3\n")
+    tickUntil(network, lambda: network.dropped)
+    vm = froth.VM("\n7 1 5 post recv recv recv recv\n", customWords={"post": (network.post, 0),
+                                                                        "recv": (network.recv, 0)})
+    assert vm.runUntilEnd() == froth.Errors.END_OF_PROGRAM
+    assert vm.stack == [1, frothnet.NetworkErrors.MESSAGES_DROPPED, 2, 1, 1, 3, 1, 1,
+                        frothnet.NetworkErrors.NO_DATA_AVAILABLE]
+    assert (network.received, network.dropped) == (3, 1)
+
+    # the server goes away: the message waiting on a code fails, and the network connects again
+    network.tick()
+    readLines(conn, 1)
+    conn.close()
+    tickUntil(network, lambda: network.codes)
+    assert network.codes == {1: frothnet.NetworkErrors.NETWORK_ERROR}
+    assert network.reconnects == 1
+    tickUntil(network, network.connected)
+    conn, _ = server.accept()
+    network.tick()
+    assert readLines(conn, 1) == ["secret"]
+    # closing fails messages waiting on a code too
+    vm = froth.VM("\n5 1 7 post\n", customWords={"post": (network.post, 0)})
+    assert vm.runUntilEnd() == froth.Errors.END_OF_PROGRAM
+    network.tick()
+    assert list(network.inflight) == [2]
+    conn.close()
+    network.close()
+    assert network.codes == {1: frothnet.NetworkErrors.NETWORK_ERROR, 2: frothnet.NetworkErrors.NETWORK_ERROR}
+
+for overflow, expected in ((frothnet.DROP_NEWEST, [[1, 1, 1], [2, 1, 1]]), (frothnet.WAIT, [[1, 1, 1], [2, 1, 1]])):
+    with socket.create_server(("127.0.0.1", 0)) as server:
+        network = frothnet.Network(f"127.0.0.1:{server.getsockname()[1]}", "secret", maxQueue=2, overflow=overflow)
+        conn, _ = server.accept()
+        with conn:
+            tickUntil(network, network.connected)
+            conn.sendall(b"12\n1 1\n1 2\n")
+            tickUntil(network, lambda: len(network.queue) == 2)
+            conn.sendall(b"1 3\n")
+            for _ in range(20):
+                network.tick()
+                time.sleep(0.001)
+            assert list(network.queue) == expected
+            assert network.dropped == (overflow == frothnet.DROP_NEWEST)
+            network.queue.popleft()
+            if overflow == frothnet.WAIT:
+                tickUntil(network, lambda: len(network.queue) == 2)
+                assert network.queue[-1] == [3, 1, 1]
+        network.close()
+
+# a full queue under WAIT still lets return codes through, so a suspended send isn't stuck
+with socket.create_server(("127.0.0.1", 0)) as server:
+    network = frothnet.Network(f"127.0.0.1:{server.getsockname()[1]}", "secret", maxQueue=1, overflow=frothnet.WAIT)
+    conn, _ = server.accept()
+    with conn:
+        tickUntil(network, network.connected)
+        conn.sendall(b"12\n1 1\n")
+        tickUntil(network, lambda: network.queue)
+        vm = froth.VM("\n4 1 3 send recv recv\n", customWords={"send": (network.send, 0), "recv": (network.recv, 0)})
+        assert vm.tick() == froth.Errors.SUCCESS
+        assert vm.tick() == froth.Errors.YIELD
+        network.tick()
+        readLines(conn, 2)
+        conn.sendall(b"1 2\n-1\n")
+        tickUntil(network, lambda: frothnet.resumeIfReplied(vm))
+        assert list(network.held) == [[2, 1, 1]]
+        assert vm.runUntilEnd() == froth.Errors.END_OF_PROGRAM
+        assert vm.stack == [-1, 1, 1, 1, frothnet.NetworkErrors.NO_DATA_AVAILABLE]
+        tickUntil(network, lambda: network.queue)
+        assert list(network.queue) == [[2, 1, 1]]
+
+        # but only sets aside another maxQueue of messages while it waits
+        vm = froth.VM("\n5 1 3 send\n", customWords={"send": (network.send, 0)})
+        assert vm.tick() == froth.Errors.SUCCESS
+        assert vm.tick() == froth.Errors.YIELD
+        network.tick()
+        readLines(conn, 1)
+        conn.sendall(b"1 3\n")
+        tickUntil(network, lambda: network.held)
+        conn.sendall(b"1 4\n-1\n")
+        for _ in range(20):
+            network.tick()
+            time.sleep(0.001)
+        assert list(network.held) == [[3, 1, 1]] and not frothnet.resumeIfReplied(vm)
+        network.queue.popleft()
+        tickUntil(network, lambda: frothnet.resumeIfReplied(vm))
+        assert list(network.queue) == [[3, 1, 1]] and list(network.held) == [[4, 1, 1]]
+    network.close()
+
+print("PASSED RECONNECT TESTS")
+
+async def RelayTest():
+    relay, server, address = await startRelay()
+
+    async with server:
+        text = frothnet.Network(address, "secret")
+        binary = frothnet.Network(address, "secret", binary=True)
+        wrong = frothnet.Network(address, "wrong")
+        await tickUntilAsync(lambda: text.id and binary.mode, text, binary, wrong)
+        assert (text.id, binary.id, binary.mode) == (1, 2, "binary")
+        assert sorted(relay.clients) == [1, 2]
+
+        vm = froth.VM("\n5 6 2 2 post 7 1 99 post\n", customWords={"post": (text.post, 0)})
+        assert vm.runUntilEnd() == froth.Errors.END_OF_PROGRAM
+        vm = froth.VM(f"\n{1 << 40} 1 1 post\n", customWords={"post": (binary.post, 0)})
+        assert vm.runUntilEnd() == froth.Errors.END_OF_PROGRAM
+        await tickUntilAsync(lambda: text.queue and binary.queue and len(text.codes) == 2 and binary.codes,
+                             text, binary)
+        assert text.codes == {1: frothnet.NetworkErrors.SUCCESS, 2: frothnet.NetworkErrors.DESTINATION_DOESNT_EXIST}
+        assert binary.codes == {1: frothnet.NetworkErrors.SUCCESS}
+        assert list(binary.queue) == [[5, 6, 1, 2]]
+        assert list(text.queue) == [[1 << 40, 2, 1]]
+        assert relay.relayed == 2
+
+        text.close()
+        binary.close()
+        wrong.close()
+        await tickUntilAsync(lambda: not relay.clients)
+
+asyncio.run(RelayTest())
+
+async def DeadClientTest():
+    # a sender waiting for room in a client's queue is let go when that client disconnects
+    relay = frothserver.Server("secret", queueSize=1)
+    sender = frothserver.Client(1, None, 10)
+    slow = frothserver.Client(2, None, 1)
+    relay.clients = {1: sender, 2: slow}
+    await relay.relay(sender, None, 2, [5])
+    blocked = asyncio.ensure_future(relay.relay(sender, None, 2, [6]))
+    await asyncio.sleep(0.01)
+    assert not blocked.done()
+    del relay.clients[2]
+    slow.closed.set()
+    await asyncio.wait_for(blocked, 1)
+    assert [sender.queue.get_nowait() for _ in range(2)] == [b"-1\n", b"-2\n"]
+    assert not await slow.put(b"7\n")
+
+asyncio.run(DeadClientTest())
+
+async def InvalidMessageTest():
+    relay = frothserver.Server("secret")
+    sender = frothserver.Client(1, None, 10)
+    sender.binary = True
+    text = frothserver.Client(2, None, 10)
+    relay.clients = {1: sender, 2: text}
+    # an empty message to a text client would read as a return code
+    await relay.relay(sender, 3, 2, [])
+    assert text.queue.empty()
+    assert sender.queue.get_nowait() == frothnet.encodeFrame(frothnet.CODE, [3, frothnet.NetworkErrors.INVALID_MESSAGE])
+    await relay.relay(sender, 4, 1, [])
+    assert sender.queue.get_nowait() == frothnet.encodeFrame(frothnet.MESSAGE, [1])
+    assert sender.queue.get_nowait() == frothnet.encodeFrame(frothnet.CODE, [4, frothnet.NetworkErrors.SUCCESS])
+    assert relay.relayed == 1
+    # a text client's value too large for a binary frame fails that message, not the sender's connection
+    await relay.relay(text, None, 1, [1 << 63])
+    assert sender.queue.empty()
+    assert text.queue.get_nowait() == b"%d\n" % frothnet.NetworkErrors.INVALID_MESSAGE
+    await relay.textMessage(text, b"1 5\n")
+    assert sender.queue.get_nowait() == frothnet.encodeFrame(frothnet.MESSAGE, [2, 5])
+
+asyncio.run(InvalidMessageTest())
+print("PASSED RELAY SERVER TESTS")
+
+async def BatchNetworkTest():
+    relay, server, address = await startRelay()
+
+    def words(network):
+        return {name: (getattr(network, name), 0) for name in ("recv", "recvn", "recvmem", "send", "sendmany")}
+
+    async with server:
+        text = frothnet.Network(address, "secret")
+        binary = frothnet.Network(address, "secret", binary=True)
+        await tickUntilAsync(lambda: text.id and binary.mode, text, binary)
+
+        # to binary, itself and nobody, then a second message to both
+        vm = froth.VM("\n5 6 2 2 1 99 3 sendmany\n7 1 1 2 2 sendmany\n", customWords=words(text))
+        assert vm.tick() == froth.Errors.SUCCESS
+        assert vm.tick() == froth.Errors.YIELD
+        await tickUntilAsync(lambda: frothnet.resumeIfReplied(vm), text, binary)
+        assert vm.runUntilEnd() == froth.Errors.YIELD
+        await tickUntilAsync(lambda: frothnet.resumeIfReplied(vm), text, binary)
+        assert vm.runUntilEnd() == froth.Errors.END_OF_PROGRAM
+        assert vm.stack == [-1, -1, -2, -1, -1]
+        await tickUntilAsync(lambda: len(binary.queue) == 2 and len(text.queue) == 2, text, binary)
+
+        vm = froth.VM("\n0 recvn 5 recvn 1 recvn\n", customWords=words(binary))
+        assert vm.runUntilEnd() == froth.Errors.END_OF_PROGRAM
+        assert vm.stack == [0, 5, 6, 1, 2, 7, 1, 1, 2, 0]
+
+        vm = froth.VM("\n8 alloc 0 6 recvmem 4 4 recvmem 0 8 memload 5 5 recvmem\n", customWords=words(text))
+        assert vm.runUntilEnd() == froth.Errors.MEMORY_ERROR
+        assert vm.stack == [1, 1, 2, 1, 5, 6, 1, 1, 7, 0]
+
+        # a message too long for the region is dropped instead of blocking the one behind it
+        text.queue.extend([[1, 2, 3, 4, 5, 2, 5], [8, 2, 1]])
+        vm = froth.VM("\n4 alloc 0 4 recvmem 0 4 recvmem 0 3 memload\n", customWords=words(text))
+        assert vm.runUntilEnd() == froth.Errors.END_OF_PROGRAM
+        assert vm.stack == [1, frothnet.NetworkErrors.MESSAGES_DROPPED, 1, 2, 8]
+        assert text.dropped == 1
+
+        text.close()
+        binary.close()
+        await tickUntilAsync(lambda: not relay.clients)
+
+asyncio.run(BatchNetworkTest())
+
+async def ScheduledSendTest():
+    # under frothasync a send is awaited, with a task ticking the network meanwhile
+    relay, server, address = await startRelay()
+    async with server:
+        network = frothnet.Network(address, "secret")
+
+        async def ticker():
+            while True:
+                network.tick()
+                await asyncio.sleep(0.001)
+
+        ticking = asyncio.ensure_future(ticker())
+        await tickUntilAsync(lambda: network.id)
+        scheduler = frothasync.Scheduler()
+        vm = froth.VM("\n5 1 1 send 6 1 2 send 7 1 1 99 2 sendmany\n",
+                      customWords={"send": (network.send, 0), "sendmany": (network.sendmany, 0)})
+        assert await asyncio.wait_for(scheduler.spawn(vm), 5) == froth.Errors.END_OF_PROGRAM
+        assert vm.stack == [-1, -2, -1, -2]
+        assert not network.waiters
+        network.close()
+        ticking.cancel()
+        await tickUntilAsync(lambda: not relay.clients)
+
+asyncio.run(ScheduledSendTest())
+print("PASSED BATCH NETWORK TESTS")
+
+async def AsyncTest():
+    mailbox = asyncio.Queue()
+
+    async def send(vm):
+        await mailbox.put(vm.stack.pop())
+
+    async def recv(vm):
+        vm.stack.append(await mailbox.get())
+
+    async def fail(vm):
+        return froth.Errors.UNKNOWN_WORD
+
+    scheduler = frothasync.Scheduler(slice=10)
+    receiver = scheduler.spawn(froth.VM("\nrecv recv add\nfail 5\n", customWords={"recv": (recv, 0), "fail": (fail, 0)}))
+    spinner = scheduler.spawn(froth.VM("\nmacro spin spin ;\nspin\n", maxDepth=10))
+    sender = scheduler.spawn(froth.VM("\n20 send\n22 send\n", customWords={"send": (send, 0)}), hz=100)
+    looper = froth.VM("\nline jump\n")
+    scheduler.spawn(looper)
+    assert await receiver == froth.Errors.UNKNOWN_WORD
+    assert await sender == froth.Errors.END_OF_PROGRAM
+    assert not spinner.done()
+    for task in list(scheduler.tasks):
+        task.cancel()
+
+asyncio.run(AsyncTest())
+
+# a word returning some other non-error value is a bug in the word, not a suspension
+vm = froth.VM("\n1 2 pop\n", customWords={"pop": (lambda vm: vm.stack.pop(), 0)})
+try:
+    vm.runUntilEnd()
+    assert False
+except AttributeError:
+    pass
+assert vm.awaiting is None
+
+print("PASSED ASYNC TESTS")
+
 
 COMMENTS = """
 1 ( 2 )
@@ -188,24 +910,128 @@ assert vm.stack == []
 
 print("PASSES RAISE TESTS")
 
-DEMO = """
-( macro that subtracts one from the top of the stack )
-macro dec ( a -- a-1 ) 1 sub ;
-
-( We will count down from this value )
-20 var loopbegin
-
-( load the position of one line below this into the variable "line_position" )
-line 1 add var line_position
-( load the current value into stack for demostration )
-loopbegin
-( draw a neat line )
-50 loopbegin mul ( 5 * current loop iter > x1 )
-10 ( y1 ) 
-loopbegin loopbegin mul  ( iter * iter > x2 )
-loopbegin 20 mul 2 div  ( iter / 2 > y2 )
-drawline ( draw, adds the id onto the stack )
-( loads our current position onto the stack, subtracts one from it, overwrite the old variable, check if it is equal to zero, )
-( and if not, jump to the beginning of the loop )
-loopbegin dec dup var loopbegin 0 eq  not if line_position jump ;
-"""
\ No newline at end of file
+TOKEN_CACHE = """
+3 var count
+count 1 sub dup var count dup 0 eq not if line jump ;
+"""
+vm = froth.VM(TOKEN_CACHE)
+end = vm.runUntilEnd()
+assert end == froth.Errors.END_OF_PROGRAM
+assert vm.stack == [2, 1, 0]
+assert len(vm.tokenCache) == 3
+vm.code = vm.code[:2] + ["7"]
+vm.pc = 2
+vm.runUntilEnd()
+assert vm.stack == [2, 1, 0, 7]
+
+print("PASSED TOKEN CACHE TESTS")
+
+COMPILED = """
+macro setx var ;
+5 setx x x
+1 if 7 var y ; y
+9 var 3 3
+"""
+vm = froth.VM(COMPILED)
+end = vm.runUntilEnd()
+assert end == froth.Errors.END_OF_PROGRAM
+assert vm.stack == [5, 7, 9]
+
+print("PASSED COMPILER TESTS")
+
+class Unoptimized(froth.VM):
+    peephole = False
+
+vm = froth.VM("")
+ops = vm.compile(vm.tokenizer("50 2 mul 1 add dup var x 0 eq not swap drop"))
+assert [op[0] for op in ops] == [froth.VM.opPush, froth.VM.opDupVar, froth.VM.opNonZero, froth.VM.opNip]
+assert ops[0][1] == (101,)
+assert ops[0][2] == [50, 2, "mul", 1, "add"]
+
+for program in (MACRO, "\n5 1 sub 3\n", "\n1 sub\n", "\n1 add\n", "\n0 eq not\n", "\ndup var x\n",
+                "\n4 swap drop\n", "\n4 drop drop\n", "\n4 over over\n", "\n1 0 div\n", "\n9 var 2 2 2 add\n",
+                "\nSTACK_UNDERFLOW -1 catch\n1 sub 2 sub\n"):
+    results = []
+    for cls in (froth.VM, Unoptimized):
+        vm = cls(program, output=io.StringIO())
+        results.append((vm.runUntilEnd(), vm.stack, vm.variables, vm.pc))
+    assert results[0] == results[1], program
+
+print("PASSED PEEPHOLE TESTS")
+
+REBIND = """
+macro m 1 ; 3 var n
+m n line var back
+macro m 2 ; n 1 sub dup var n if back jump ;
+5 var m m
+"""
+vm = froth.VM(REBIND)
+assert vm.runUntilEnd() == froth.Errors.END_OF_PROGRAM
+assert vm.stack == [1, 3, 2, 2, 2, 1, 5]
+
+program = froth.Program("\nm m\n")
+first = froth.VM(program)
+second = froth.VM(program)
+first.bindName("m", macro=True)
+first.variables["m"] = froth.Block([1])
+second.bindName("m", macro=True)
+second.variables["m"] = froth.Block([2])
+assert first.runUntilEnd() == second.runUntilEnd() == froth.Errors.END_OF_PROGRAM
+assert first.stack == [1, 1] and second.stack == [2, 2]
+
+print("PASSED INLINE CACHE TESTS")
+
+program = froth.Program(COMPILED).precompile()
+first = froth.VM(program)
+second = froth.VM(program)
+assert first.runUntilEnd() == froth.Errors.END_OF_PROGRAM
+assert first.stack == [5, 7, 9]
+assert program.lines[1] is not None
+assert first.lines is not program.lines
+assert second.runUntilEnd() == froth.Errors.END_OF_PROGRAM
+assert second.stack == [5, 7, 9]
+assert froth.VM(program).lines is program.lines
+
+program = froth.Program(CUSTOM, customWords={"custom": (CustomWord, 0)})
+vm = froth.VM(program)
+assert vm.runUntilEnd() == froth.Errors.END_OF_PROGRAM
+assert vm.stack == [50]
+assert "custom" not in froth.tokenMap
+vm = froth.VM(program, customWords={"custom": (lambda vm: vm.stack.append(51), 0)})
+assert vm.lines is not program.lines
+assert vm.runUntilEnd() == froth.Errors.END_OF_PROGRAM
+assert vm.stack == [51]
+
+print("PASSED PROGRAM TESTS")
+
+RECURSION = """
+macro countdown dup if 1 sub countdown ; ;
+100000 countdown
+macro deep 1 add deep 1 ;
+0 deep
+"""
+vm = froth.VM(RECURSION, maxDepth=50)
+end = vm.runUntilEnd()
+assert end == froth.Errors.DEPTH_EXCEEDED
+assert vm.stack == [0, 50]
+
+print("PASSED RECURSION TESTS")
+
+SKIP = """
+# comment
+
+( just a comment )
+line
+
+# another
+line
+"""
+vm = froth.VM(SKIP)
+ticks = 0
+while (end := vm.tick()) == froth.Errors.SUCCESS:
+    ticks += 1
+assert end == froth.Errors.END_OF_PROGRAM
+assert ticks == 4
+assert vm.stack == [4, 7]
+
+print("PASSED LINE SKIP TESTS")
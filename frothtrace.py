@@ -0,0 +1,169 @@
+"""Tracing hooks for froth VMs.
+
+    class LineLogger(Tracer):
+        def line(self, vm):
+            print("running line", vm.pc)
+
+    attach(vm, LineLogger(), every=10)
+
+Subclass Tracer and override the events you want; attach() only hooks the VM into the events
+the tracer overrides, so e.g. a line tracer doesn't slow down every word and a VM with no tracer
+runs exactly as it always did. With every=N each hook is only called on every Nth of its events.
+"""
+import functools
+import itertools
+
+import froth
+
+EVENTS = ("line", "word", "error", "catch", "memoryWrite", "debug")
+
+
+class Tracer(object):
+    def line(self, vm):
+        "A line is about to start, vm.pc is its number"
+
+    def word(self, vm, op):
+        "op, a compiled (func, args, source words), is about to run"
+
+    def error(self, vm, ret):
+        "The program stopped with the error ret"
+
+    def catch(self, vm, ret, line):
+        "The error ret was caught and the program carries on at line"
+
+    def memoryWrite(self, vm, address, size):
+        "size cells starting at address were written"
+
+    def debug(self, vm):
+        "The debug word ran. Without a tracer overriding this it prints the VM's state"
+
+
+class TracedMemory(object):
+    "Stands in for a VM's memory, reporting writes"
+    def __init__(self, memory, vm, hook):
+        self.memory = memory
+        self.vm = vm
+        self.hook = hook
+
+    def __getattr__(self, name):
+        return getattr(self.memory, name)
+
+    def __len__(self):
+        return len(self.memory)
+
+    def __iter__(self):
+        return iter(self.memory)
+
+    def __getitem__(self, pos):
+        return self.memory[pos]
+
+    def __setitem__(self, pos, value):
+        self.memory[pos] = value
+        self.hook(self.vm, pos, 1)
+
+    def write(self, pos, values):
+        self.memory.write(pos, values)
+        self.hook(self.vm, pos, len(values))
+
+    def copy(self, src, dst, size):
+        self.memory.copy(src, dst, size)
+        self.hook(self.vm, dst, size)
+
+    def fill(self, pos, size, value):
+        self.memory.fill(pos, size, value)
+        self.hook(self.vm, pos, size)
+
+
+def sample(hook, every):
+    "hook, only called every every-th time"
+    if every <= 1:
+        return hook
+    counter = itertools.count(1)
+
+    def sampled(*args):
+        if not next(counter) % every:
+            return hook(*args)
+    return sampled
+
+
+def attach(vm, tracer, every=1):
+    "Send vm's events to tracer from now on, returns vm"
+    if "exec" in vm.__dict__:
+        raise ValueError("vm already has a tracer or profiler attached")
+    hooks = {event: sample(getattr(tracer, event), every) for event in EVENTS
+             if getattr(type(tracer), event) is not getattr(Tracer, event)}
+
+    if "line" in hooks or "error" in hooks:
+        vm.tick = tracedTick(vm, vm.tick, hooks.get("error"))
+        vm.resume = tracedResume(vm, vm.resume, hooks.get("error"))
+    if "line" in hooks:
+        vm.runLine = tracedRunLine(vm, vm.runLine, hooks["line"])
+    if "catch" in hooks:
+        vm.endLine = tracedEndLine(vm, vm.endLine, hooks["catch"])
+    if "memoryWrite" in hooks:
+        vm.memory = TracedMemory(vm.memory, vm, hooks["memoryWrite"])
+    if "debug" in hooks:
+        vm.debugHook = hooks["debug"]
+    # exec is always replaced, so attach() can tell the vm is already traced
+    vm.exec = tracedExec(vm, hooks["word"]) if "word" in hooks else vm.exec
+    return vm
+
+
+def detach(vm):
+    "Stop tracing vm"
+    for name in ("tick", "resume", "runLine", "endLine", "exec", "debugHook"):
+        vm.__dict__.pop(name, None)
+    if isinstance(vm.memory, TracedMemory):
+        vm.memory = vm.memory.memory
+
+
+def isError(ret):
+    return ret not in (froth.Errors.SUCCESS, froth.Errors.YIELD, froth.Errors.END_OF_PROGRAM)
+
+
+def tracedTick(vm, tick, error):
+    def traced(steps=None):
+        ret = tick(steps)
+        if error and isError(ret):
+            error(vm, ret)
+        return ret
+    return traced
+
+
+def tracedResume(vm, resume, error):
+    def traced(ret):
+        ret = resume(ret)
+        if error and isError(ret):
+            error(vm, ret)
+        return ret
+    return traced
+
+
+def tracedRunLine(vm, runLine, line):
+    def traced():
+        # the VM starts at line -1, which isn't reported
+        if not vm.suspended and vm.pc >= 0:
+            if vm.pc < len(vm.skip):
+                vm.pc = vm.skip[vm.pc]
+            if vm.pc < len(vm.code):
+                line(vm)
+        return runLine()
+    return traced
+
+
+def tracedEndLine(vm, endLine, catch):
+    def traced(ret):
+        caught = getattr(ret, "value", None) in vm.catchMap and ret is not froth.Errors.YIELD
+        result = endLine(ret)
+        if caught:
+            catch(vm, ret, vm.pc)
+        return result
+    return traced
+
+
+def tracedExec(vm, word):
+    "VM.exec, telling word about every op before it runs"
+    def run(vm, func, args, source):
+        word(vm, (func, args, source))
+        return func(vm, *args)
+    return functools.partial(froth.VM.exec, vm, run)
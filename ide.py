@@ -8,13 +8,13 @@ import ttkwidgets
 import froth
 import re
 import time
-import socket
-import select
 import uuid
-import enum
 import os
 
-import frothtests
+import frothnet
+from frothnet import DummyNet, Network
+
+import frothdemo
 
 styleLoader = """
 set base_theme_dir awthemes
@@ -30,14 +30,6 @@ package ifneeded awlight 7.6 \
 """
 _STYLE = None
 
-class NetworkErrors(enum.IntEnum):
-    SUCCESS = -1
-    DESTINATION_DOESNT_EXIST = -2
-    NO_DATA_AVAILABLE = -3
-
-    NETWORK_ERROR = -99
-
-
 def wordBounds(editor):
     lineNum, pos = editor.index(INSERT).split(".")
     begin = int(editor.index("insert -1c wordstart").split(".")[1])
@@ -121,89 +113,6 @@ class Display(Canvas):
         self.delete(vm.stack.pop())
 
 
-class DummyNet(object):
-    def recv(self, vm):
-        "( -- ...data sender length/err )"
-        pass
-
-    def send(self, vm):
-        "( ...data length target -- returnCode )"
-        pass
-
-    def tick(self):
-        pass
-
-
-class Network(object):
-    def __init__(self, conn: str, key: str):
-        self.sock = None
-        self.queue = []
-        self.host, self.port = conn.split(":")
-        self.key = key
-
-        self.id = ""
-
-        self.buf = b""
-        self.connect()
-
-    def connect(self):
-        self.sock = socket.socket()
-        self.sock.connect((self.host, int(self.port)))
-        self.Send(self.key)
-
-    def tick(self):
-        if not self.id and len(self.queue) > 0 and len(self.queue[0]) == 1:
-            pop = self.queue.pop(0)[0]
-            self.id = int(pop)
-        sel = select.select((self.sock, ), (), (), 0)[0]
-        if not sel: return
-        try:
-            data = self.sock.recv(2048)
-            self.buf += data
-            tmp = self.buf.split(b"\n")
-            self.buf = tmp.pop()
-            for line in tmp:
-                line = line.split()
-                if len(line) == 1:
-                    self.queue.append(line)
-                    continue
-                sender = int(line[0])
-                stack = map(int, line[1:])
-                stack = list(stack)
-                length = len(stack)
-
-                stack.append(sender)
-                stack.append(length)
-                self.queue.append(stack)
-
-        except:
-            self.connect()
-
-    def recv(self, vm):
-        "( -- ...data sender length/err )"
-        if not self.queue:
-            vm.stack.append(NetworkErrors.NO_DATA_AVAILABLE.value)
-            return
-        vm.stack += self.queue.pop(0)
-
-    def send(self, vm):
-        "( ...data length target -- returnCode )"
-        target = vm.stack.pop()
-        length = vm.stack.pop() * -1
-        data = vm.stack[length:]
-        vm.stack = vm.stack[:length]
-        self.sock.send((f"{target} "+" ".join(map(str, data))).encode("utf8") +b"\n")
-        time.sleep(1)
-        response = self.sock.recv(3).rstrip()
-
-        if len(response) != 2:
-            return NetworkErrors.NETWORK_ERROR
-        vm.stack.append(int(response))
-
-    def Send(self, data):
-        self.sock.send(b"%s\n" % data.encode("utf8"))
-
-
 class Tooltip(Toplevel):
     ActiveTooltip = None
 
@@ -346,7 +255,7 @@ class IDE(Tk):
         self.tags = ["number", "builtin", "macro"]
 
         self.editor.grid(row=0, column=1, sticky=NSEW)
-        self.editor.insert("0.0", frothtests.DEMO)
+        self.editor.insert("0.0", frothdemo.DEMO)
 
         self.sidebar = ttk.Frame(self)
         self.sidebar.grid(row=0, column=2, sticky=N, padx=3)
@@ -409,6 +318,7 @@ class IDE(Tk):
 
 
         self.builtinre = re.compile(f"\\b({'|'.join(froth.tokenMap.keys())}|;)\\b")
+        self.builtinWords = ()
         self.macrore = re.compile("")
         self.commentre = re.compile("\( .+? \)")
         self.words = {}
@@ -433,13 +343,19 @@ class IDE(Tk):
             self.network.tick()
 
             time.sleep(max(0.001, time.time() - t))
-            if self.vm and self.tickdelay < time.time():
+            if self.vm and self.vm.awaiting is not None:
+                # waiting on a send's return code
+                frothnet.resumeIfReplied(self.vm)
+            elif self.vm and self.tickdelay < time.time():
                 self.ret = self.vm.tick()
                 self.stackviewer.Refresh()
                 self.editor.tag_remove("highlight", "0.0", END)
                 self.editor.tag_add("highlight", f"{self.vm.pc+1}.0", f"{self.vm.pc+1}.end")
 
-                if self.ret != froth.Errors.SUCCESS and self.ret != froth.Errors.END_OF_PROGRAM:
+                if self.ret == froth.Errors.YIELD:
+                    # suspended on a send, picked back up above once its return codes are in
+                    pass
+                elif self.ret != froth.Errors.SUCCESS and self.ret != froth.Errors.END_OF_PROGRAM:
                     self.editor.tag_add("error", f"{self.vm.pc+1}.0", f"{self.vm.pc+1}.end")
                     self.editor.see("%d.0"%(self.vm.pc+1))
                     self.Stop()
@@ -450,7 +366,10 @@ class IDE(Tk):
                 refreshtime = time.time() + 3
 
                 if isinstance(self.network, Network):
-                    self.netid.config(text=f"ID: {self.network.id}")
+                    if self.network.connected():
+                        self.netid.config(text=f"ID: {self.network.id}, dropped {self.network.dropped}")
+                    else:
+                        self.netid.config(text="Connecting...")
 
     def NewFile(self):
 
@@ -555,6 +474,8 @@ class IDE(Tk):
                 Tooltip.Clear()
 
     def Connect(self):
+        if isinstance(self.network, Network):
+            self.network.close()
         self.network = Network(self.netstring.get(), self.netpass.get())
         self.network.tick()
 
@@ -571,17 +492,25 @@ class IDE(Tk):
         self.editor.configure(state=DISABLED)
         self.terminal.delete("0.0", END)
         self.terminal.queue = []
-        self.vm = froth.VM(self.editor.get("0.0", END), output=self.terminal, customWords={
+        self.vm = froth.VM(self.editor.get("0.0", END), output=self.terminal, bufferSize=0, customWords={
             "drawline": (self.display.drawline, 0),
             "deleteline": (self.display.deleteline, 0),
             "recv": (self.network.recv, 0),
             "send": (self.network.send, 0),
+            "recvn": (self.network.recvn, 0),
+            "recvmem": (self.network.recvmem, 0),
+            "sendmany": (self.network.sendmany, 0),
+            "post": (self.network.post, 0),
+            "postresult": (self.network.postresult, 0),
             "delchr": (self.terminal.delchr, 0),
             "read": (self.terminal.read, 0),
         })
         self.realTokenMap = self.vm.tokens
 
-        self.builtinre = re.compile(f"\\b({'|'.join(self.vm.tokens.keys())}|;)\\b")
+        words = tuple(self.vm.tokens.keys())
+        if words != self.builtinWords:
+            self.builtinWords = words
+            self.builtinre = re.compile(f"\\b({'|'.join(words)}|;)\\b")
 
         self.stackviewer.stack = self.vm.stack
         self.runButton.config(text="Stop", command=self.Stop)